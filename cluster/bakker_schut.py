@@ -21,7 +21,8 @@ def bakker_kMeans(data, **kwargs):
     Cytometry,  vol. 14, 1993, pp. 649-659.
 
     @type data: array
-    @param data: The data to be clustered
+    @param data: The data to be clustered; unused (and may be None) when 
+                 the prepare keyword argument is given.
     @type kwargs: dict
     @param kwargs: The following args are accepted:
         - numClusters: The number of clusters to form
@@ -40,7 +41,10 @@ def bakker_kMeans(data, **kwargs):
         initClusters = int(kwargs['numClusters'])
     
     # Log transform
-    logData = tm.getMethod('log')(data)
+    if 'prepare' in kwargs:
+        logData = kwargs['prepare']('log')
+    else:
+        logData = tm.getMethod('log')(data)
     
     # Choose large # (200 as suggested by authors) of non-random initial centers
     centers = util.kinit(logData, initClusters)
@@ -75,11 +79,8 @@ def merge(limit, ids, clusters, dist=None, minpair=None, newID=None):
         
     
     if len(clusters) <= limit:
-        unique = np.unique(ids)
-        saved = dict(zip(unique, range(len(unique))))
         # reassign cluster ids to a contiguous range
-        for i, id in enumerate(ids):
-            ids[i] = saved[id]
+        ids[:] = np.unique(ids, return_inverse=True)[1]
                 
         return ids
     
@@ -98,9 +99,7 @@ def merge(limit, ids, clusters, dist=None, minpair=None, newID=None):
     newID = np.max(ids) + 1
     clusters[newID] = merged
     
-    for i, id in enumerate(ids):
-        if id in minpair:
-            ids[i] = newID 
+    ids[np.in1d(ids, minpair)] = newID
     
     return merge(limit, ids, clusters, dist, minpair, newID)
     
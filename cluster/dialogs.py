@@ -91,7 +91,7 @@ class ClusterInfoDialog(wx.Dialog):
             label.SetBackgroundColour(plot.methods.plotColors[i])
             self.formSizer.Add(label, 1, wx.EXPAND)
             # % of total
-            percent = float(len(cluster))/len(DataStore.getCurrentDataSet().data)*100
+            percent = float(len(cluster))/DataStore.getCurrentDataSet().EventCount*100
             label = wx.StaticText(self, -1, '%6.2f' % percent + ' %', (30, 10))
             self.formSizer.Add(label, 1, wx.EXPAND | wx.ALIGN_CENTER)
             # number of events
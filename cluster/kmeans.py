@@ -15,7 +15,8 @@ def kmeans(data, **kwargs):
     Perform k-means clustering on unstructured N-dimensional data.
     
     @type data: array
-    @param data: The data to be clustered
+    @param data: The data to be clustered; unused (and may be None) when 
+                 the prepare keyword argument is given.
     @type kwargs: dict
     @param kwargs: The following args are accepted:
         - numClusters: The number of clusters to form (returned number of clusters may be less than k).
@@ -50,7 +51,10 @@ def kmeans(data, **kwargs):
         smartCenters = kwargs['smartCenters']
     
     
-    logData = tm.getMethod('log')(data)
+    if 'prepare' in kwargs:
+        logData = kwargs['prepare']('log')
+    else:
+        logData = tm.getMethod('log')(data)
     if initialCenters is not None:
         (clusterIDs, err, nOpt) = pc.kcluster(logData, k, npass=npasses, method=method)
         msg = "Number of rounds optimal solution was found: %i" % nOpt
@@ -70,6 +70,19 @@ def getStringRepr(methodID):
         return methods[methodID][1]
     
 
+def usesPrepare(methodID):
+    """
+    Determine whether a clustering method reads its data only through the 
+    prepare function (see L{cluster}), so that the untransformed data need
+    not be extracted for it. This is the case for the built-in methods.
+    
+    @type methodID: int
+    @param methodID: One of the module-defined ID_* constants for the available methods.
+    @rtype: bool
+    """
+    return not methods[methodID][4]
+    
+
 def cluster(clusterType, data, **kwargs):
     """
     Intended to be a pass-through interface for performing different clustering algorithms.
@@ -78,11 +91,17 @@ def cluster(clusterType, data, **kwargs):
     @param clusterType: Specifies the type of clustering algorithm to use. 
         Module pre-defined constants such as ID_KMEANS can be used. 
     @type data: array
-    @param data: The data to be clustered.
+    @param data: The data to be clustered, or None when prepare is given to 
+        a method for which L{usesPrepare} is True.
     @type kwargs: dict
     @param kwargs: Used to pass any arguments specific to a clustering algorithm.
         See the clustering algorithm method signatures for necessary arguments.
         Optional arguments can be found in the documentation for those methods.
+        Callers may also pass prepare, a function of a transform ID (and 
+        transform options) returning the transformed data, which methods 
+        should use rather than transforming the data themselves so that 
+        the transformed data can be cached (see L{data.store.FacsData.getPrepared}).
+        The transformed arrays are shared, and so are read-only.
     
     @rtype: tuple
     @return: A list where each element indicates the cluster membership of the 
@@ -5,7 +5,7 @@ Created on Aug 25, 2009
 '''
 import data.handle as dh
 from data.store import FacsData
-from data.store import DataStore
+from data.store import DataStore, Clustering
 
 import numpy as np
 from numpy import random
@@ -74,9 +74,11 @@ def isolateClusters(selection, datasetName):
         currFCData = DataStore.getCurrentDataSet()
         if (datasetName == ""):
             datasetName = currFCData.displayname
-        clusters = separate(currFCData.data, currFCData.getCurrentClustering())
-        # merge selected clusters
-        newData = dh.mergeData(selection, clusters)
+        # select the events of the chosen clusters, referring to the events
+        # of the top-level data set rather than copying them
+        groups = currFCData.getCurrentClustering().groups()
+        rows = np.sort(np.concatenate([groups[i] for i in selection]))
+        newData = currFCData.selectEvents(rows)
         # assign new data set to the store
         newFCData = FacsData('', currFCData.labels, newData, parent=currFCData.ID)
         newFCData.displayname = datasetName
@@ -84,7 +86,7 @@ def isolateClusters(selection, datasetName):
         
         # add basic text annotations
         textAnn = {'parent': currFCData.displayname}
-        textAnn['events'] = len(newFCData.data)
+        textAnn['events'] = newFCData.EventCount
         newFCData.annotations['text'] = textAnn
         
         DataStore.add(newFCData)
@@ -174,7 +176,7 @@ def distSq(a, b):
     @rtype: float
     @return: The distance squared between points p1 and p2.
     """
-    diff = a-b
+    diff = np.asarray(a, dtype=np.float) - b
     return np.sum(diff*diff)
 
 
@@ -192,8 +194,11 @@ def separate(data, ids):
     @rtype: list
     @return: A list of array objects representing clusters.
     """
-    clustIDs = np.unique(ids)
-    return [data[ids==id] for id in clustIDs]
+    ids = Clustering(ids)
+    if not len(ids):
+        return []
+    # gather the events sorted by cluster once, and split them into views
+    return np.split(data[ids.Order], ids.Bounds)
 
 
 def nonSymmetricClusterDistance(c1, c2):
@@ -302,8 +307,9 @@ def reassignClusterIDs(src, dst):
         taken.append(centerEQ[i])
     
     # Renumber the cluster IDs in the destination to match the IDs of the closest src center
-    tmp = [centerEQ[id] for id in dstids]
-    DataStore.getData()[dst[0]].clustering[dst[1]] = tmp
+    renumber = np.arange(max(centerEQ.keys() + [int(dstids.max())]) + 1)
+    renumber[centerEQ.keys()] = centerEQ.values()
+    DataStore.getData()[dst[0]].clustering[dst[1]] = Clustering(renumber[dstids])
             
 
 def clusteringInfo(fData, id):
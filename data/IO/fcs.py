@@ -6,17 +6,53 @@ https://code.google.com/p/py-fcm/source/browse/src/io/readfcs.py
 
 This version of the reader is from the 07/14/2010 revision
 """
+from data.lazy import LazyData
 from error import UnimplementedFcsDataMode, warnUser
 
 from operator import and_, itemgetter
-from math import log
-from struct import calcsize, unpack
+from math import ceil, log
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import copy
 import re
 import numpy
 import os
 
 
 
+# events unpacked at a time from bit packed data segments (a multiple of 8)
+PACKED_BLOCK_EVENTS = 65536
+
+# bytes of delimited ASCII data segments tokenized at a time
+ASCII_BLOCK_BYTES = 1024**2
+
+# events converted at a time when a delimited ASCII segment is read in full
+ASCII_BLOCK_EVENTS = 262144
+
+# events compensated with each matrix multiply
+COMP_BLOCK_EVENTS = 262144
+
+# inverted spillover matrices, keyed on the matrix contents
+_inverse_spill = {}
+
+# events converted and written at a time by saveFCS
+WRITE_BLOCK_EVENTS = 262144
+
+# TEXT keywords describing the layout of the written file, which saveFCS sets 
+# itself rather than copying from the original data set
+LAYOUT_KEYWORDS = ['beginanalysis', 'endanalysis', 'beginstext', 'endstext', 
+                   'begindata', 'enddata', 'byteord', 'datatype', 'mode', 
+                   'nextdata', 'par', 'tot']
+
+# keywords defined by the FCS 3.1 standard (the reader drops the $ prefix)
+STANDARD_KEYWORDS = LAYOUT_KEYWORDS + ['abrt', 'btim', 'cells', 'com', 'csmode', 
+                    'csvbits', 'cyt', 'cytsn', 'date', 'etim', 'exp', 'fil', 
+                    'gate', 'inst', 'lost', 'op', 'originality', 'plateid', 
+                    'platename', 'proj', 'smno', 'spillover', 'src', 'sys', 
+                    'timestep', 'tr', 'vol', 'wellid', 'last_modified', 
+                    'last_modifier']
+
+
 class FCSreader(object):
     """
     Read and parse standard FCS3.0 format files.
@@ -27,51 +63,80 @@ class FCSreader(object):
         #self._fh = cStringIO.StringIO(open(filename, 'rb').read())
         self._fh = None
         self.cur_offset = 0
+        self._datasets = None
         self.spill = spill
         self.sidx = sidx
+        self.fcData = fcData
+        self.window = window
     
     def register(self):
-        from ..io import FILE_INPUT
-        return {FILE_INPUT: self.get_FCMdata}
+        from ..io import FILE_INPUT, FILE_OUTPUT
+        return {FILE_INPUT: self.get_FCMdata, FILE_OUTPUT: self.save}
     
     @property
     def FileType(self):
-        return 'Binary FCS 3.0 (*.fcs)|*.fcs'
+        return 'Binary FCS 3.1 (*.fcs)|*.fcs'
+    
+    def save(self):
+        """
+        Save the data set to a binary FCS 3.1 file, keeping its keywords.
+        
+        If the data set has a clustering selected, the user is asked whether 
+        to add the cluster IDs as an extra channel.
+        """
+        clusterIDs = None
+        if self.fcData.selectedClustering is not None and self.window is not None:
+            import wx
+            if wx.MessageBox('Add the selected clustering to the file as a "Cluster" channel?', 
+                             'Export Clustering', wx.YES_NO | wx.ICON_QUESTION, 
+                             self.window) == wx.YES:
+                clusterIDs = self.fcData.getCurrentClustering()
+        
+        saveFCS(self.filename, self.fcData.labels, self.fcData, 
+                self.fcData.annotations.get('text'), clusterIDs, 
+                'compensation' in self.fcData.annotations)
        
-    def get_FCMdata(self, auto_comp=True):
-        """Return the next FCM data set stored in a FCS file"""
+    def get_FCMdata(self, auto_comp=False, mmap=False, preview=None, 
+                    spill=None, sidx=None, dataset=None, **kwargs):
+        """
+        Return the next FCM data set stored in a FCS file, or the data set 
+        with the given index in a file containing several (see get_datasets).
+        
+        If mmap is True and the layout of the data segment allows it, the
+        events are returned as a memory-mapped FCSMappedData instance that
+        is only decoded when its columns are requested.
+        
+        If preview is given, only the first preview events are read from 
+        the data segment.
+        
+        If auto_comp is True, the events are compensated with the spillover
+        matrix given by spill and sidx (or to the reader), or else with the 
+        matrix in the $SPILL/$SPILLOVER keyword of the file. Compensated 
+        events are returned as float32. By default, as in earlier versions,
+        the events are left uncompensated in their stored type.
+        """
+        if spill is not None:
+            self.spill, self.sidx = spill, sidx
+        if dataset is not None:
+            self.select_dataset(dataset)
+        
         self._fh = open(self.filename, 'rb')
-       
-        # parse headers
-        header = self.parse_header(self.cur_offset)
-       
-        # parse text
-        text = self.parse_text(self.cur_offset, header['text_start'], header['text_stop'])
-       
-        # parse annalysis
-        try:
-            astart = text['beginanalysis']
-        except KeyError:
-            astart = header['analysis_start']
-        try:
-            astop = text['endanalysis']
-        except KeyError:
-            astop = header['analysis_end']
-        analysis = self.parse_analysis(self.cur_offset, astart, astop)
-        # parse data
-        try:
-            dstart = int(text['begindata'])
-        except KeyError:
-            dstart = header['data_start']
-        try:
-            dstop = int(text['enddata'])
-        except KeyError:
-            dstop = header['data_end']
-       
-        #account for LMD reporting the wrong values for the size of the data segment
-        lmd = self.fix_lmd(self.cur_offset,header['text_start'], header['text_stop'] )
-        dstop = dstop+lmd
-        data = self.parse_data(self.cur_offset, dstart, dstop, text)
+        header, text, analysis, dstart, dstop = self.parse_segments(self.cur_offset)
+        comp = self.get_compensation(text) if auto_comp else None
+        data = None
+        if mmap and preview is None:
+            # mapped events are compensated as they are decoded
+            data = self.map_data(self.cur_offset, dstart, dstop, text, comp)
+        if data is None:
+            if preview is not None:
+                data = self.parse_data(self.cur_offset, dstart, dstop, text, 
+                                       0, min(int(preview), int(text['tot'])))
+            else:
+                data = self.parse_data(self.cur_offset, dstart, dstop, text)
+            if comp is not None:
+                data = compensate(data, comp[0], comp[1])
+        self._fh.close()
+        
         # build fcmdata object
         channels = []
         scchannels = []
@@ -95,20 +160,6 @@ class FCSreader(object):
                     pass
        
 #        if auto_comp:
-#            if self.spill is None:
-#                try:
-#                    self.spill, self.sidx = get_spill(text['spill'])
-#                except KeyError:
-#                    pass
-#            if self.spill is not None and self.sidx is not None:
-#                idx = []
-#                for si in self.sidx:
-#                    idx.append(base_chan_name.index(si))
-#                c = _compensate(data[:,idx], self.spill)
-#                data[:,idx] = c
-#               
-#               
-#                   
 #            if header['version'] == 3.0 and self.logicle == True:
 #                T = 262144
 #                m = 4.5 * log(10)
@@ -134,15 +185,230 @@ class FCSreader(object):
             defXform.append(item[1])
             
         
-        return (channels, data, {'text': text, 'header': header,
-                                 'analysis': analysis, 'defXform': defXform})
+        annotations = {'text': text, 'header': header,
+                       'analysis': analysis, 'defXform': defXform}
+        if comp is not None:
+            annotations['compensation'] = {'spill': comp[0].tolist(), 
+                                           'channels': [base_chan_name[i] for i in comp[1]]}
+        if self._datasets is not None and len(self._datasets) > 1:
+            annotations['dataset'] = (self._datasets.index(self.cur_offset), 
+                                      len(self._datasets))
+        return (channels, data, annotations)
+    
+    def get_all_FCMdata(self, datasets=None, parallel=False, **kwargs):
+        """
+        Return a list of the FCM data sets stored in a FCS file, as returned
+        by get_FCMdata. 
+        
+        The data sets are located by a single pass over their HEADER and 
+        TEXT segments, after which each selected DATA segment is read 
+        directly. If parallel is True, the data sets are decoded on a pool 
+        of threads, each with its own file handle.
+        """
+        offsets = self.get_datasets()
+        if datasets is None:
+            datasets = range(len(offsets))
+        
+        def load(i):
+            reader = FCSreader(self.filename, auto_logicle=self.logicle, 
+                               sidx=self.sidx, spill=self.spill)
+            reader._datasets = offsets
+            return reader.get_FCMdata(dataset=i, **kwargs)
+        
+        if not parallel or len(datasets) < 2:
+            return [load(i) for i in datasets]
+        pool = ThreadPool(min(cpu_count(), len(datasets)))
+        try:
+            return pool.map(load, datasets)
+        finally:
+            pool.close()
+    
+    def get_datasets(self):
+        """
+        Locate the data sets in the file by following the $NEXTDATA offsets
+        from the first, reading only the HEADER and TEXT segments of each.
+        The offsets are remembered, so the file is only traversed once.
+        
+        Returns the list of the byte offsets of each data set in the file.
+        """
+        if self._datasets is not None:
+            return self._datasets
+        
+        close = self._fh is None or self._fh.closed
+        if close:
+            self._fh = open(self.filename, 'rb')
+        try:
+            size = os.fstat(self._fh.fileno()).st_size
+            offsets = []
+            offset = 0
+            while True:
+                offsets.append(offset)
+                header = self.parse_header(offset)
+                text = self.parse_text(offset, header['text_start'], header['text_stop'])
+                try:
+                    nxt = int(text.get('nextdata', 0) or 0)
+                except ValueError:
+                    break
+                # stop at the end of the chain, or at offsets that are bogus
+                if nxt <= 0 or offset+nxt >= size or offset+nxt in offsets:
+                    break
+                offset += nxt
+        finally:
+            if close:
+                self._fh.close()
+        
+        self._datasets = offsets
+        return offsets
+    
+    def countDataSets(self):
+        """Return the number of data sets stored in the file."""
+        return len(self.get_datasets())
+    
+    def select_dataset(self, dataset):
+        """Make the data set with the given index the one that is read next."""
+        offsets = self.get_datasets()
+        if not 0 <= dataset < len(offsets):
+            raise IndexError('%s contains %i data sets' % (self.filename, len(offsets)))
+        self.cur_offset = offsets[dataset]
+       
+   
+    def get_FCMinfo(self):
+        """
+        Return the channel names and the header and text annotations of the 
+        next FCM data set stored in a FCS file, reading only the HEADER and 
+        TEXT segments.
+        """
+        self._fh = open(self.filename, 'rb')
+        try:
+            header = self.parse_header(self.cur_offset)
+            text = self.parse_text(self.cur_offset, header['text_start'], header['text_stop'])
+        finally:
+            self._fh.close()
+        
+        channels = []
+        for i in range(1,int(text['par'])+1):
+            channels.append(text.get('p%ds' % i, text['p%dn' % i]))
+        
+        return (channels, {'text': text, 'header': header})
+    
+    def iter_events(self, chunksize=1000000, auto_comp=False, dataset=None):
+        """
+        Iterate over the events of the next FCM data set stored in a FCS file
+        in blocks of at most chunksize rows. Only one block is decoded and 
+        held in memory at a time, so files larger than RAM can be processed.
+        """
+        if dataset is not None:
+            self.select_dataset(dataset)
+        # read through a copy with a file handle of its own, so the handle of
+        # this reader is left alone while the iteration is suspended
+        reader = copy.copy(self)
+        reader._fh = open(self.filename, 'rb')
+        try:
+            offset = reader.cur_offset
+            header, text, analysis, dstart, dstop = reader.parse_segments(offset)
+            comp = reader.get_compensation(text) if auto_comp else None
+            tot = int(text['tot'])
+            widths = ascii_widths(text)
+            if widths is not None and '*' in widths:
+                # delimited fields can only be found by reading from the start
+                blocks = reader.iter_ascii_data(offset, dstart, dstop, len(widths), 
+                                                tot, chunksize)
+            else:
+                blocks = (reader.parse_data(offset, dstart, dstop, text, 
+                                            first, min(chunksize, tot-first))
+                          for first in xrange(0, tot, chunksize))
+            for data in blocks:
+                if comp is not None:
+                    data = compensate(data, comp[0], comp[1])
+                yield data
+        finally:
+            reader._fh.close()
+    
+    def get_compensation(self, text):
+        """
+        Return the spillover matrix for the data set and the column indices 
+        of the channels it applies to, or None if there is no spillover 
+        matrix or its channels are not all in the data set.
+        
+        The matrix supplied to the reader is used if given, otherwise the 
+        one stored in the $SPILL or $SPILLOVER keyword. Channels may be 
+        identified by index or by their $PnN or $PnS names.
+        """
+        spill, sidx = self.spill, self.sidx
+        if spill is None:
+            if 'spill' in text:
+                spill, sidx = get_spill(text['spill'])
+            elif 'spillover' in text:
+                spill, sidx = get_spill(text['spillover'])
+            else:
+                return None
+        
+        par = int(text['par'])
+        names = [text['p%dn' % i] for i in range(1, par+1)]
+        snames = [text.get('p%ds' % i) for i in range(1, par+1)]
+        idx = []
+        for s in sidx:
+            if isinstance(s, (int, long)):
+                idx.append(s)
+            elif s in names:
+                idx.append(names.index(s))
+            elif s in snames:
+                idx.append(snames.index(s))
+            else:
+                return None
+        
+        return numpy.asarray(spill, dtype=numpy.float64), idx
+    
+    def parse_segments(self, offset):
+        """
+        Parse the header, text and analysis segments of the data set at the 
+        offset and locate its data segment.
+        
+        Returns the header, text and analysis dicts along with the start and 
+        stop of the data segment.
+        """
+        # parse headers
+        header = self.parse_header(offset)
+       
+        # parse text
+        text = self.parse_text(offset, header['text_start'], header['text_stop'])
+       
+        # parse annalysis
+        try:
+            astart = text['beginanalysis']
+        except KeyError:
+            astart = header['analysis_start']
+        try:
+            astop = text['endanalysis']
+        except KeyError:
+            astop = header['analysis_end']
+        analysis = self.parse_analysis(offset, astart, astop)
+        
+        # locate data, the header offsets are 0 for segments past 99,999,999 bytes
+        dstart = int(text.get('begindata', 0)) or header['data_start']
+        dstop = int(text.get('enddata', 0)) or header['data_end']
        
+        #account for LMD reporting the wrong values for the size of the data segment
+        lmd = self.fix_lmd(offset, header['text_start'], header['text_stop'])
+        dstop = dstop+lmd
+        
+        return header, text, analysis, dstart, dstop
    
     def read_bytes(self, offset, start, stop):
         """Read in bytes from start to stop inclusive."""
         self._fh.seek(offset+start)
        
         return self._fh.read(stop-start+1)
+    
+    def read_array(self, offset, start, dtype, count):
+        """
+        Read count items of the given numpy dtype beginning at start. The 
+        bytes are read once into a writable buffer and viewed in place.
+        """
+        self._fh.seek(offset+start)
+        buf = bytearray(count*dtype.itemsize)
+        nbytes = self._fh.readinto(buf)
+        return numpy.frombuffer(buf, dtype=dtype, count=nbytes/dtype.itemsize)
    
     def parse_header(self, offset):
         """
@@ -155,8 +421,14 @@ class FCSreader(object):
         header['version'] = float(self.read_bytes(offset, 3, 5))
         header['text_start'] = int(self.read_bytes(offset, 10, 17))
         header['text_stop'] = int(self.read_bytes(offset, 18, 25))
-        header['data_start'] = int(self.read_bytes(offset, 26, 33))
-        header['data_end'] = int(self.read_bytes(offset, 34, 41))
+        try:
+            header['data_start'] = int(self.read_bytes(offset, 26, 33))
+        except ValueError:
+            header['data_start'] = 0
+        try:
+            header['data_end'] = int(self.read_bytes(offset, 34, 41))
+        except ValueError:
+            header['data_end'] = 0
         try:
             header['analysis_start'] = int(self.read_bytes(offset, 42, 49))
         except ValueError:
@@ -193,22 +465,24 @@ class FCSreader(object):
             text = self.read_bytes(offset, start, stop)
             return parse_pairs(text)
    
-    def parse_data(self, offset, start, stop, text):
-        """return numpy.array of data segment of fcs file"""
+    def parse_data(self, offset, start, stop, text, first=0, count=None):
+        """
+        return numpy.array of data segment of fcs file
+        
+        Only count events beginning with event first are decoded if given.
+        """
        
         dtype = text['datatype']
         mode = text['mode']
-        tot = int(text['tot'])
+        tot = int(text['tot']) - first if count is None else count
         if mode == 'c' or mode == 'u':
             raise UnimplementedFcsDataMode(mode)
+        
+        if dtype.lower() == 'a':
+            return self.parse_ascii_data(offset, start, stop, ascii_widths(text), 
+                                         tot, first)
        
-        if text['byteord'] == '1,2,3,4' or text['byteord'] == '1,2':
-            order = '<'
-        elif text['byteord'] == '4,3,2,1' or text['byteord'] == '2,1':
-            order = '>'
-        else:
-            warnUser("unsupported byte order %s , using default @" % text['byteord'] )
-            order = '@'
+        order = byte_order(text['byteord'])
         # from here on out we assume mode l (list)
        
         bitwidth = []
@@ -218,60 +492,225 @@ class FCSreader(object):
             drange.append(int(text['p%dr' %i]))
        
         if dtype.lower() == 'i':
-            data = self.parse_int_data(offset, start, stop, bitwidth, drange, tot, order)
-        elif dtype.lower() == 'f' or dtype.lower() == 'd':
-            data = self.parse_float_data(offset, start, stop, dtype.lower(), tot, order)
-        else: # ascii
-            data = self.parse_ascii_data(offset, start, stop, bitwidth, dtype, tot, order)
+            data = self.parse_int_data(offset, start, stop, bitwidth, drange, tot, order, first)
+        else:
+            data = self.parse_float_data(offset, start, stop, dtype.lower(), tot, order, 
+                                         len(bitwidth), first)
         return data
    
-    def parse_int_data(self, offset, start, stop, bitwidth, drange, tot, order):
-        """Parse out and return integer list data from fcs file"""
-       
-        if reduce(and_, [item in [8, 16, 32] for item in bitwidth]):
-            if len(set(bitwidth)) == 1: # uniform size for all parameters
-                # calculate how much data to read in.
-                num_items = (stop-start+1)/calcsize(fmt_integer(bitwidth[0]))
-                #unpack into a list
-                tmp = unpack('%s%d%s' % (order, num_items, fmt_integer(bitwidth[0])),
-                                    self.read_bytes(offset, start, stop))
-               
-
-
-            else: # parameter sizes are different e.g. 8, 8, 16,8, 32 ... do one at a time
-                unused_bitwidths = map(int, map(log2, drange))
-                tmp = []
-                cur = start
-                while cur < stop:
-                    for i, curwidth in enumerate(bitwidth):
-                        bitmask = mask_integer(curwidth, unused_bitwidths[i])
-                        nbytes = curwidth/8
-                        bin_string = self.read_bytes(offset, cur, cur+nbytes-1)
-                        cur += nbytes
-                        val = bitmask & unpack('%s%s' % (order, fmt_integer(curwidth)), bin_string)[0]
-                        tmp.append(val)
-        else: #non starndard bitwiths...  Does this happen?
-            warnUser('Non-standard bitwidths for data segments')
+    def map_data(self, offset, start, stop, text, comp=None):
+        """
+        return a memory-mapped view of the data segment of fcs file, or None 
+        if the segment layout can not be mapped directly
+        
+        comp is the (spillover matrix, channel indices) pair to 
+        compensate the events with as they are decoded.
+        """
+        
+        dtype = text['datatype'].lower()
+        tot = int(text['tot'])
+        par = int(text['par'])
+        if text['mode'].lower() != 'l':
+            return None
+        
+        bitwidth = []
+        drange = []
+        for i in range(1, par+1):
+            bitwidth.append(int(text['p%db' %i]))
+            drange.append(int(text['p%dr' %i]))
+        
+        masks = None
+        if dtype == 'i':
+            if len(set(bitwidth)) != 1 or bitwidth[0] not in [8, 16, 32]:
+                return None
+            fmt = fmt_integer(bitwidth[0])
+            masks = [mask_integer(b, range_bitwidth(b, r)) for b, r in zip(bitwidth, drange)]
+            if set(masks) == set([mask_integer(bitwidth[0], bitwidth[0])]):
+                masks = None
+        elif dtype == 'f' or dtype == 'd':
+            fmt = dtype
+        else:
             return None
-        return numpy.array(tmp).reshape((tot, len(bitwidth)))
+        
+        return FCSMappedData(self.filename, offset+start, 
+                             fmt_dtype(byte_order(text['byteord']), fmt), 
+                             (tot, par), masks, comp=comp)
    
-    def parse_float_data(self, offset, start, stop, dtype, tot, order):
-        """Parse out and return float list data from fcs file"""
+    def parse_int_data(self, offset, start, stop, bitwidth, drange, tot, order, first=0):
+        """Parse out and return tot events of integer list data from fcs file"""
        
-        #count up how many to read in
-        num_items = (stop-start+1)/calcsize(dtype)
+        # masks for the bits outside the range of each parameter
+        masks = [mask_integer(b, range_bitwidth(b, r)) for b, r in zip(bitwidth, drange)]
+        
+        if reduce(and_, [item in [8, 16, 32] for item in bitwidth]):
+            if len(set(bitwidth)) == 1: # uniform size for all parameters
+                # view the whole segment as a typed array in one read
+                dtype = fmt_dtype(order, fmt_integer(bitwidth[0]))
+                tmp = self.read_array(offset, start + first*len(bitwidth)*dtype.itemsize, 
+                                      dtype, tot*len(bitwidth))
+                tmp = tmp.reshape((tot, len(bitwidth)))
+                masks = numpy.array(masks, dtype=tmp.dtype)
+                if (masks != mask_integer(bitwidth[0], bitwidth[0])).any():
+                    numpy.bitwise_and(tmp, masks, tmp)
+                return native_order(tmp)
 
-        tmp = unpack('%s%d%s' % (order, num_items, dtype), self.read_bytes(offset, start, stop))
-        return numpy.array(tmp).reshape((tot, len(tmp)/tot))
+            else: # parameter sizes are different e.g. 8, 8, 16,8, 32 ... 
+                # read every event as one record with a field per parameter
+                dtype = numpy.dtype([('p%d' % i, fmt_dtype(order, fmt_integer(b))) 
+                                     for i, b in enumerate(bitwidth)])
+                events = self.read_array(offset, start + first*dtype.itemsize, dtype, tot)
+                tmp = numpy.empty((tot, len(bitwidth)), dtype=uint_dtype(max(bitwidth)))
+                for i, name in enumerate(dtype.names):
+                    tmp[:,i] = numpy.bitwise_and(events[name], masks[i])
+                return tmp
+        else: # non byte-aligned bitwidths, e.g. 10 or 12 bit packed data
+            return self.parse_packed_data(offset, start, bitwidth, masks, tot, order, first)
+    
+    def parse_packed_data(self, offset, start, bitwidth, masks, tot, order, first=0):
+        """
+        Parse out integer list data packed at arbitrary bit widths. Events are
+        unpacked in blocks to bound the memory used for the expanded bits.
+        """
+        
+        evbits = sum(bitwidth)
+        masks = numpy.array(masks, dtype=numpy.uint64)
+        tmp = numpy.empty((tot, len(bitwidth)), dtype=uint_dtype(max(bitwidth)))
+        # blocks hold a multiple of 8 events so only the first may start mid-byte
+        for i in xrange(0, tot, PACKED_BLOCK_EVENTS):
+            n = min(PACKED_BLOCK_EVENTS, tot-i)
+            bit = (first+i)*evbits
+            buf = self.read_array(offset, start + bit/8, 
+                                  numpy.dtype(numpy.uint8), (bit%8 + n*evbits + 7)/8)
+            values = unpack_bits(buf, bitwidth, order, bit%8)[:n]
+            tmp[i:i+n] = numpy.bitwise_and(values, masks)
+        return tmp
    
-    def parse_ascii_data(self, offset, start, stop, bitwidth, dtype, tot, order):
-        """Parse out ascii encoded data from fcs file"""
+    def parse_float_data(self, offset, start, stop, dtype, tot, order, par, first=0):
+        """Parse out and return tot events of float list data from fcs file"""
        
-        num_items = (stop-start+1)/calcsize(dtype)
-        tmp = unpack('%s%d%s' % (order, num_items, dtype), self.read_bytes(offset, start, stop))
-        return numpy.array(tmp).reshape((tot, len(tmp)/tot))
+        dtype = fmt_dtype(order, dtype)
+        tmp = self.read_array(offset, start + first*par*dtype.itemsize, dtype, tot*par)
+        return native_order(tmp.reshape((tot, par)))
+   
+    def parse_ascii_data(self, offset, start, stop, widths, tot, first=0):
+        """
+        Parse out and return tot events of ascii encoded data from fcs file,
+        beginning with event first. Fields of fixed width ($PnB characters)
+        are read for just those events, while delimited fields ($PnB of *)
+        are tokenized from the start of the segment.
+        """
+        
+        par = len(widths)
+        if '*' in widths:
+            blocks = list(self.iter_ascii_data(offset, start, stop, par, first+tot, 
+                                               ASCII_BLOCK_EVENTS))
+            if not blocks:
+                return numpy.empty((0, par))
+            return numpy.vstack(blocks)[first:]
+        
+        widths = [int(w) for w in widths]
+        evbytes = sum(widths)
+        buf = self.read_array(offset, start + first*evbytes, numpy.dtype(numpy.uint8), 
+                              tot*evbytes)
+        fields = numpy.dtype([('p%d' % i, 'S%d' % w) for i, w in enumerate(widths)])
+        events = buf[:len(buf) - len(buf) % evbytes].view(fields)
+        tmp = numpy.empty((len(events), par))
+        for i, name in enumerate(fields.names):
+            tmp[:,i] = events[name].astype(numpy.float64)
+        return tmp
+    
+    def iter_ascii_data(self, offset, start, stop, par, tot, chunksize):
+        """
+        Tokenize delimited ascii data a block of bytes at a time, yielding 
+        the first tot events in arrays of at most chunksize events.
+        """
+        
+        pos = offset + start
+        end = offset + stop + 1
+        values = []
+        rest = ''
+        done = 0
+        while pos < end and done < tot:
+            self._fh.seek(pos)
+            block = self._fh.read(min(ASCII_BLOCK_BYTES, end-pos))
+            if not block:
+                break
+            pos += len(block)
+            block = (rest + block).replace(',', ' ')
+            tokens = block.split()
+            # a value at the end of the block may continue in the next one
+            rest = ''
+            if tokens and pos < end and not block[-1:].isspace():
+                rest = tokens.pop()
+            values.extend(tokens)
+            while len(values) >= chunksize*par and done < tot:
+                n = min(chunksize, tot-done)
+                yield numpy.array(values[:n*par], dtype=numpy.float64).reshape((n, par))
+                del values[:n*par]
+                done += n
+        if rest:
+            values.append(rest)
+        n = min(len(values) / par, tot-done)
+        if n > 0:
+            yield numpy.array(values[:n*par], dtype=numpy.float64).reshape((n, par))
            
        
+class FCSMappedData(LazyData):
+    """
+    Event data backed by a numpy.memmap of the data segment of an FCS file.
+    
+    Only the pages of the file holding requested columns are read, and the
+    range masks and conversion to native byte order are applied per column 
+    on access. If a compensation is given, requesting any compensated 
+    column reads all of them, and compensated events are float32.
+    """
+    def __init__(self, filename, start, dtype, shape, masks=None, cols=None, comp=None):
+        self.filename = filename
+        self.start = start
+        self.dtype = dtype
+        self.masks = masks
+        self.comp = comp
+        self._map = numpy.memmap(filename, dtype=dtype, mode='r', 
+                                 offset=start, shape=shape)
+        # the order of the file columns as seen by the user
+        self.cols = range(shape[1]) if cols is None else list(cols)
+    
+    @property
+    def shape(self):
+        return (self._map.shape[0], len(self.cols))
+    
+    def decode(self, raw, cols):
+        """return the masked, native order copy of raw events from the file columns cols"""
+        if self.masks is not None:
+            masks = numpy.array([self.masks[c] for c in cols], dtype=raw.dtype)
+            raw = numpy.bitwise_and(raw, masks)
+        return native_order(numpy.asarray(raw))
+    
+    def read(self, rows, cols):
+        """return the decoded events in the slice rows from the file columns cols"""
+        if self.comp is None or not set(cols) & set(self.comp[1]):
+            return self.decode(self._map[rows, cols], cols)
+        
+        spill, idx = self.comp
+        need = sorted(set(cols) | set(idx))
+        data = compensate(self.decode(self._map[rows, need], need), spill, 
+                          [need.index(i) for i in idx])
+        return data[:, [need.index(c) for c in cols]]
+    
+    def columns(self, dims):
+        return self.read(slice(None), [self.cols[d] for d in dims])
+    
+    def rows(self, start, stop):
+        return self.read(slice(start, stop), self.cols)
+    
+    def materialize(self):
+        return self.columns(range(len(self.cols)))
+    
+    def reorder(self, columnOrder):
+        return FCSMappedData(self.filename, self.start, self.dtype, 
+                             self._map.shape, self.masks, 
+                             [self.cols[i] for i in columnOrder], self.comp)
+       
 def parse_pairs(text):
     """return key/value pairs from a delimited string"""
     delim = text[0]
@@ -284,9 +723,20 @@ def parse_pairs(text):
     tmp = text[1:-1].replace('$','')
     # match the delimited character unless it's doubled
     regex = re.compile('(?<=[^%s])%s(?!%s)' % (delim, delim, delim))
-    tmp = regex.split(tmp)
+    tmp = [x.replace(text[0]*2, text[0]) for x in regex.split(tmp)]
     return dict(zip([ x.lower() for x in tmp[::2]], tmp[1::2]))
    
+def byte_order(byteord):
+    """return the struct byte order character for the $BYTEORD keyword"""
+    
+    if byteord == '1,2,3,4' or byteord == '1,2':
+        return '<'
+    elif byteord == '4,3,2,1' or byteord == '2,1':
+        return '>'
+    else:
+        warnUser("unsupported byte order %s , using default @" % byteord )
+        return '@'
+
 def fmt_integer(b):
     """return binary format of an integer"""
    
@@ -303,15 +753,64 @@ def fmt_integer(b):
 def mask_integer(b, ub):
     """return bitmask of an integer and a bitwitdh"""
    
-    if b == 8:
-        return (0xFF >> (b-ub))
-    elif b == 16:
-        return (0xFFFF >> (b-ub))
-    elif b == 32:
-        return (0xFFFFFFFF >> (b-ub))
-    else:
-        print "Cannot handle integers of bit size %d" % b
-        return None
+    return ((1 << b) - 1) >> (b-ub)
+
+def unpack_bits(buf, bitwidth, order, skip=0):
+    """
+    return the unsigned integers packed back to back at the given bit widths 
+    in buf, after the first skip bits, as an array with one row per event
+    
+    Values are read most significant bit first for big endian ('>') data, 
+    and least significant bit first for little endian data.
+    """
+    
+    bits = numpy.unpackbits(numpy.frombuffer(buf, dtype=numpy.uint8))
+    if order != '>':
+        bits = bits.reshape((-1, 8))[:,::-1].ravel()
+    bits = bits[skip:]
+    evbits = sum(bitwidth)
+    nevents = len(bits) / evbits
+    bits = bits[:nevents*evbits].reshape((nevents, evbits))
+    
+    values = numpy.empty((nevents, len(bitwidth)), dtype=numpy.uint64)
+    pos = 0
+    for i, b in enumerate(bitwidth):
+        weights = numpy.uint64(1) << numpy.arange(b, dtype=numpy.uint64)
+        if order == '>':
+            weights = weights[::-1]
+        values[:,i] = numpy.dot(bits[:,pos:pos+b], weights)
+        pos += b
+    return values
+
+def fmt_dtype(order, fmt):
+    """return the numpy dtype for a struct byte order and format character"""
+    
+    if order == '@':
+        order = '='
+    return numpy.dtype(order + fmt)
+
+def uint_dtype(b):
+    """return the smallest unsigned integer dtype holding b bits"""
+    
+    for size in [8, 16, 32]:
+        if b <= size:
+            return numpy.dtype('uint%d' % size)
+    return numpy.dtype(numpy.uint64)
+
+def native_order(a):
+    """return the array a in native byte order, swapping its bytes in place if needed"""
+    
+    if a.dtype.isnative:
+        return a
+    return a.byteswap(True).view(a.dtype.newbyteorder('='))
+
+def range_bitwidth(b, r):
+    """return the number of bits needed to hold values of range r in b bits"""
+    
+    r = int(r)
+    if r <= 1:
+        return b
+    return min(b, int(ceil(log2(r))))
 
 def log_factory(base):
     """constructor of various log based functions"""
@@ -322,12 +821,200 @@ def log_factory(base):
 
 log2 = log_factory(2)
 
-def loadFCS(filename, auto_logicle=True, auto_comp=True, spill=None):
+def ascii_widths(text):
+    """
+    return the $PnB field widths of an ascii data set (numbers of characters,
+    or * for delimited values), or None for other data types
+    """
+    
+    if text['datatype'].lower() != 'a':
+        return None
+    return [text['p%db' % i].strip() for i in range(1, int(text['par'])+1)]
+
+def get_spill(text):
+    """
+    return the spillover matrix and the names of the channels it applies to
+    from the value of a $SPILL or $SPILLOVER keyword
+    """
+    
+    spill = text.split(',')
+    n = int(spill[0])
+    markers = [item.strip() for item in spill[1:n+1]]
+    values = [float(item) for item in spill[n+1:n+1+n*n]]
+    return numpy.array(values).reshape((n, n)), markers
+
+def read_spill(filename):
+    """
+    return the spillover matrix and the names of the channels it applies to
+    from a text file holding either the value of a $SPILL keyword, or the
+    channel names on the first line followed by one row of the matrix per
+    channel, all separated by commas
+    """
+    
+    with open(filename, 'r') as fh:
+        lines = [line.strip() for line in fh if line.strip()]
+    if not lines:
+        raise ValueError('%s is empty' % filename)
+    if len(lines) == 1:
+        return get_spill(lines[0])
+    markers = [item.strip() for item in lines[0].split(',')]
+    values = [[float(item) for item in line.split(',')] for line in lines[1:]]
+    spill = numpy.array(values)
+    if spill.shape != (len(markers), len(markers)):
+        raise ValueError('%s does not hold a %ix%i matrix' % (filename, len(markers), len(markers)))
+    return spill, markers
+
+def invert_spill(spill):
+    """return the (cached) float32 inverse of a spillover matrix"""
+    
+    spill = numpy.asarray(spill, dtype=numpy.float64)
+    key = (spill.shape, spill.tostring())
+    if key not in _inverse_spill:
+        _inverse_spill[key] = numpy.linalg.inv(spill).astype(numpy.float32)
+    return _inverse_spill[key]
+
+def compensate(data, spill, idx):
+    """
+    return a float32 copy of data with the columns idx compensated for the
+    spillover matrix spill, multiplying one block of events at a time by
+    the inverted matrix
+    """
+    
+    inv = invert_spill(spill)
+    out = numpy.array(data, dtype=numpy.float32)
+    for i in xrange(0, len(out), COMP_BLOCK_EVENTS):
+        block = out[i:i+COMP_BLOCK_EVENTS]
+        block[:, idx] = numpy.dot(block[:, idx], inv)
+    return out
+
+def loadFCS(filename, auto_logicle=True, auto_comp=True, spill=None, sidx=None):
     """Load and return a FCM data object from an FCS file"""
    
-    tmp = FCSreader(filename, auto_logicle, spill=spill)
+    tmp = FCSreader(filename, auto_logicle=auto_logicle, spill=spill, sidx=sidx)
     return tmp.get_FCMdata(auto_comp)
 
+def probeFCS(filename):
+    """Return the channel names and HEADER/TEXT annotations of an FCS file without reading its data"""
+    
+    return FCSreader(filename).get_FCMinfo()
+
+def saveFCS(filename, labels, data, text=None, clusterIDs=None, compensated=False):
+    """
+    Write the events to an FCS 3.1 file as little-endian float32 list mode 
+    data.
+    
+    data may be an array, a LazyData instance or a FacsData, and is 
+    converted and written a block of events at a time. The keywords in text 
+    (as parsed by FCSreader) are kept, except those describing the layout 
+    of the original file. Channel keywords are carried over for the channels
+    whose $PnS or $PnN name is a label, and the spillover matrix is dropped
+    if the data are compensated. If clusterIDs is given, the cluster of 
+    each event is added as a final channel named "Cluster".
+    """
+    text = dict(text or {})
+    tot = len(data) if not hasattr(data, 'EventCount') else data.EventCount
+    if hasattr(data, 'getRows'):
+        rows = data.getRows
+    elif isinstance(data, LazyData):
+        rows = data.rows
+    else:
+        rows = lambda start, stop: data[start:stop]
+    
+    labels = list(labels)
+    if clusterIDs is not None:
+        clusterIDs = numpy.asarray(clusterIDs)
+        labels.append('Cluster')
+    
+    # match the original channels to the labels
+    par = int(text.get('par', 0) or 0)
+    names = {}
+    for i in range(1, par+1):
+        for key in ['p%dn' % i, 'p%ds' % i]:
+            if key in text:
+                names.setdefault(text[key], i)
+    
+    keywords = {}
+    channel_key = re.compile('p(\\d+)([a-z]+)$')
+    for key, value in text.iteritems():
+        if key in LAYOUT_KEYWORDS or channel_key.match(key):
+            continue
+        if compensated and key in ['spill', 'spillover']:
+            continue
+        keywords[key] = value
+    
+    nch = len(labels) - (clusterIDs is not None)
+    for j, label in enumerate(labels[:nch]):
+        i = names.get(label)
+        if i is not None:
+            for key, value in text.iteritems():
+                m = channel_key.match(key)
+                if m and int(m.group(1)) == i:
+                    keywords['p%d%s' % (j+1, m.group(2))] = value
+        keywords.setdefault('p%dr' % (j+1), '262144')
+        # the label is the $PnS name if the channel has one, as in the reader
+        if keywords.setdefault('p%dn' % (j+1), label) == label:
+            keywords.pop('p%ds' % (j+1), None)
+        else:
+            keywords['p%ds' % (j+1)] = label
+    if clusterIDs is not None:
+        keywords['p%dn' % len(labels)] = labels[-1]
+        keywords['p%dr' % len(labels)] = str(int(clusterIDs.max())+1 if len(clusterIDs) else 1)
+    for j in range(len(labels)):
+        keywords['p%db' % (j+1)] = '32'
+        keywords['p%de' % (j+1)] = '0,0'
+    
+    keywords.update({'byteord': '1,2,3,4', 'datatype': 'F', 'mode': 'L', 
+                     'nextdata': '0', 'par': str(len(labels)), 'tot': str(tot),
+                     'beginanalysis': '0', 'endanalysis': '0', 
+                     'beginstext': '0', 'endstext': '0'})
+    
+    # the TEXT segment holds the data offsets, so its length depends on them
+    nbytes = tot * len(labels) * 4
+    tstart = 58
+    dstart = 0
+    while True:
+        keywords['begindata'] = str(dstart)
+        keywords['enddata'] = str(dstart + nbytes - 1 if nbytes else 0)
+        segment = fcs_text(keywords)
+        tstop = tstart + len(segment) - 1
+        if dstart == tstop + 1:
+            break
+        dstart = tstop + 1
+    
+    # the header can only hold offsets up to 99,999,999
+    offsets = [tstart, tstop, dstart, dstart + nbytes - 1 if nbytes else 0, 0, 0]
+    if offsets[3] > 99999999:
+        offsets[2:4] = [0, 0]
+    header = 'FCS3.1    ' + ''.join(['%8d' % o for o in offsets])
+    
+    with open(filename, 'wb') as fh:
+        fh.write(header)
+        fh.write(segment)
+        for i in xrange(0, tot, WRITE_BLOCK_EVENTS):
+            block = numpy.asarray(rows(i, min(i+WRITE_BLOCK_EVENTS, tot)))
+            if clusterIDs is not None:
+                block = numpy.column_stack((block, clusterIDs[i:i+len(block)]))
+            numpy.ascontiguousarray(block, dtype='<f4').tofile(fh)
+    
+def fcs_text(keywords):
+    """
+    return a TEXT segment for the keywords (without the $ prefix, as parsed 
+    by the reader), doubling any delimiters in them and dropping empty values.
+    Text is written as UTF-8, as FCS 3.1 requires
+    """
+    pairs = []
+    for key in sorted(keywords):
+        value = keywords[key]
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        value = str(value).replace('/', '//')
+        if not value:
+            continue
+        if key in STANDARD_KEYWORDS or re.match('p\\d+[a-z]+$', key):
+            key = '$' + key
+        pairs.append('%s/%s' % (key.upper().replace('/', '//'), value))
+    return '/' + '/'.join(pairs) + '/'
+
 def is_fl_channel(name):
     """
     Try and decide if a channel is a flourescent channel or if it's some other type
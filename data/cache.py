@@ -0,0 +1,355 @@
+"""
+This module contains an on-disk cache of decoded data files, so that
+reopening a file maps its events from a .npy file instead of parsing it
+again.
+
+Entries are keyed on a hash of the file contents together with the loading
+options, so modified files never hit the cache, and copies of a file share
+an entry. The content hash of each path is remembered by size and
+modification time, and a file is only looked up once it has been hashed, so
+opening a file for the first time reads it just to decode it. Hashing it and
+writing its entry are then done on a background thread. The cache is 
+limited in size, and the least recently used entries are evicted first.
+
+@author: Shareef Dabdoub
+@organization: The Ohio State University
+@organization: Nationwide Children's Hospital
+"""
+import numpy as np
+
+import cPickle
+import hashlib
+import json
+import os
+import Queue
+import tempfile
+import threading
+import time
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.find', 'cache')
+CACHE_MAX_BYTES = 4 * 1024**3
+HASH_BLOCK_BYTES = 1024**2
+
+# loading options that do not change the decoded events
+IGNORED_OPTIONS = ['mmap', 'preview']
+
+
+class DataCache(object):
+    """
+    DataCache stores the decoded events of data files as .npy files, with
+    the labels and annotations of each pickled alongside.
+
+    This class provides only class-level members so that it can be used
+    without defining a specific instance or location.
+    """
+    enabled = True
+    _dir = CACHE_DIR
+    _maxBytes = CACHE_MAX_BYTES
+    _index = None
+    _lock = threading.RLock()
+    _hashLocks = {}
+    _queue = Queue.Queue()
+    _writer = None
+
+    @classmethod
+    def configure(cls, directory=None, maxBytes=None, enabled=None):
+        """
+        Change the cache location, size limit, or whether it is used.
+
+        @type directory: str
+        @param directory: The directory holding the cache files.
+        @type maxBytes: int
+        @param maxBytes: The maximum total size of the cached events.
+        """
+        with cls._lock:
+            if directory is not None and directory != cls._dir:
+                cls._dir = directory
+                cls._index = None
+            if maxBytes is not None:
+                cls._maxBytes = maxBytes
+                cls._evict()
+            if enabled is not None:
+                cls.enabled = enabled
+
+    @classmethod
+    def lookup(cls, filename, options):
+        """
+        Retrieve a cached data file, if the file has been hashed before at 
+        its current size and modification time. The file is not read.
+
+        @type filename: str
+        @param filename: The path to the data file.
+        @type options: dict
+        @param options: The loading options passed to the input method.
+        @rtype: tuple
+        @return: As for get(), or None.
+        """
+        digest = cls.knownHash(filename)
+        if digest is None:
+            return None
+        return cls.get(cls.key(filename, options, digest))
+
+    @classmethod
+    def store(cls, filename, options, labels, data, annotations):
+        """
+        Add a decoded data file to the cache on a background thread, which 
+        hashes the file and then writes the entry (see put()). The entry is
+        dropped if the file changes before it is hashed.
+        """
+        if data.nbytes > cls._maxBytes:
+            return
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return
+        with cls._lock:
+            if cls._writer is None:
+                cls._writer = threading.Thread(target=cls._write)
+                cls._writer.daemon = True
+                cls._writer.start()
+        cls._queue.put((filename, (st.st_size, st.st_mtime), options, 
+                        (labels, data, annotations)))
+
+    @classmethod
+    def wait(cls):
+        """
+        Wait until the data files passed to store() have been written.
+        """
+        cls._queue.join()
+
+    @classmethod
+    def _write(cls):
+        while True:
+            filename, stat, options, result = cls._queue.get()
+            try:
+                digest = cls.contentHash(filename)
+                if cls.knownHash(filename, stat) == digest:
+                    cls.put(cls.key(filename, options, digest), *result)
+            except (IOError, OSError):
+                pass
+            finally:
+                cls._queue.task_done()
+
+    @classmethod
+    def key(cls, filename, options, digest=None):
+        """
+        Create the cache key for a data file loaded with the given options.
+
+        @type filename: str
+        @param filename: The path to the data file.
+        @type options: dict
+        @param options: The loading options passed to the input method.
+        @type digest: str
+        @param digest: The content hash of the file, if already known.
+        @rtype: str
+        """
+        opts = []
+        for name in sorted(options):
+            if name in IGNORED_OPTIONS:
+                continue
+            value = options[name]
+            if isinstance(value, np.ndarray):
+                value = value.tolist()
+            opts.append((name, value))
+
+        h = hashlib.sha1(digest if digest is not None else cls.contentHash(filename))
+        h.update(os.path.splitext(filename)[1].lower())
+        h.update(repr(opts))
+        return h.hexdigest()
+
+    @classmethod
+    def knownHash(cls, filename, stat=None):
+        """
+        Retrieve the remembered content hash of a file without reading it.
+
+        @type stat: tuple
+        @param stat: The (size, modification time) the file must have had 
+                     when it was hashed; by default, those it has now.
+        @rtype: str
+        @return: The hash, or None if the file was not hashed as it is.
+        """
+        path = os.path.abspath(filename)
+        if stat is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            stat = (st.st_size, st.st_mtime)
+        with cls._lock:
+            memo = cls._getIndex()['memo'].get(path)
+        if memo is not None and tuple(memo[:2]) == tuple(stat):
+            return str(memo[2])
+
+    @classmethod
+    def contentHash(cls, filename):
+        """
+        Retrieve the hash of the contents of a file, only reading the file
+        if its size or modification time changed since it was last hashed.
+        Threads asking for the same file wait for a single read of it.
+
+        @rtype: str
+        """
+        path = os.path.abspath(filename)
+        with cls._lock:
+            hashLock = cls._hashLocks.setdefault(path, threading.Lock())
+
+        with hashLock:
+            st = os.stat(path)
+            with cls._lock:
+                memo = cls._getIndex()['memo'].get(path)
+            if memo is not None and memo[:2] == [st.st_size, st.st_mtime]:
+                return str(memo[2])
+
+            h = hashlib.sha1()
+            with open(path, 'rb') as fh:
+                block = fh.read(HASH_BLOCK_BYTES)
+                while block:
+                    h.update(block)
+                    block = fh.read(HASH_BLOCK_BYTES)
+            digest = h.hexdigest()
+
+            with cls._lock:
+                cls._getIndex()['memo'][path] = [st.st_size, st.st_mtime, digest]
+                cls._saveIndex()
+        return digest
+
+    @classmethod
+    def get(cls, key):
+        """
+        Retrieve a cached data file.
+
+        @type key: str
+        @param key: The cache key returned by key().
+        @rtype: tuple
+        @return: The labels, the events memory-mapped read-only from the
+                 cache, and the annotations; or None if there is no entry.
+        """
+        with cls._lock:
+            entry = cls._getIndex()['entries'].get(key)
+            if entry is None:
+                return None
+            try:
+                data = np.load(cls._path(key, '.npy'), mmap_mode='r')
+                with open(cls._path(key, '.pickle'), 'rb') as fh:
+                    labels, annotations = cPickle.load(fh)
+            except (IOError, OSError, ValueError, EOFError, cPickle.UnpicklingError):
+                cls._remove(key)
+                cls._saveIndex()
+                return None
+
+            entry['atime'] = time.time()
+            cls._saveIndex()
+        return (labels, data, annotations)
+
+    @classmethod
+    def put(cls, key, labels, data, annotations):
+        """
+        Add a decoded data file to the cache, evicting the least recently
+        used entries if the cache grows too large. Data sets larger than the
+        cache, and any that can not be written, are not cached.
+        """
+        if data.nbytes > cls._maxBytes:
+            return
+
+        with cls._lock:
+            if key in cls._getIndex()['entries']:
+                return
+            if not os.path.exists(cls._dir):
+                os.makedirs(cls._dir)
+        
+        # write to temporary files of this writer's own (outside the lock, as
+        # large data sets take a while) so that a partial entry is never read
+        tmps = []
+        try:
+            for obj in [data, (labels, annotations)]:
+                fd, tmp = tempfile.mkstemp(suffix='.tmp', prefix=key, dir=cls._dir)
+                tmps.append(tmp)
+                with os.fdopen(fd, 'wb') as fh:
+                    if obj is data:
+                        np.save(fh, np.ascontiguousarray(data))
+                    else:
+                        cPickle.dump(obj, fh, cPickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError, cPickle.PicklingError):
+            cls._discard(tmps)
+            return
+
+        with cls._lock:
+            # another load of the same file may have published it meanwhile
+            if key not in cls._getIndex()['entries']:
+                try:
+                    for tmp, ext in zip(tmps, ['.npy', '.pickle']):
+                        os.rename(tmp, cls._path(key, ext))
+                except OSError:
+                    cls._discard(tmps)
+                    return
+                cls._getIndex()['entries'][key] = {'bytes': data.nbytes, 'atime': time.time()}
+                cls._evict()
+        cls._discard(tmps)
+
+    @classmethod
+    def _discard(cls, paths):
+        """Remove temporary files, if they still exist."""
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    @classmethod
+    def clear(cls):
+        """
+        Remove all cached data files.
+        """
+        with cls._lock:
+            for key in cls._getIndex()['entries'].keys():
+                cls._remove(key)
+            cls._saveIndex()
+
+    @classmethod
+    def _evict(cls):
+        entries = cls._getIndex()['entries']
+        total = sum([e['bytes'] for e in entries.values()])
+        for key in sorted(entries, key=lambda k: entries[k]['atime']):
+            if total <= cls._maxBytes:
+                break
+            total -= entries[key]['bytes']
+            cls._remove(key)
+        cls._saveIndex()
+
+    @classmethod
+    def _remove(cls, key):
+        cls._getIndex()['entries'].pop(key, None)
+        for ext in ['.npy', '.pickle']:
+            try:
+                os.remove(cls._path(key, ext))
+            except OSError:
+                pass
+
+    @classmethod
+    def _path(cls, key, ext):
+        return os.path.join(cls._dir, key + ext)
+
+    @classmethod
+    def _getIndex(cls):
+        if cls._index is None:
+            try:
+                with open(os.path.join(cls._dir, 'index.json'), 'r') as fh:
+                    cls._index = json.load(fh)
+            except (IOError, ValueError):
+                cls._index = {'entries': {}, 'memo': {}}
+        return cls._index
+
+    @classmethod
+    def _saveIndex(cls):
+        path = os.path.join(cls._dir, 'index.json')
+        try:
+            if not os.path.exists(cls._dir):
+                os.makedirs(cls._dir)
+            with open(path + '.tmp', 'w') as fh:
+                json.dump(cls._index, fh)
+            # rename can not replace an existing file on Windows
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError):
+            pass
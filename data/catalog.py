@@ -0,0 +1,250 @@
+"""
+This module maintains an on-disk catalog of the FCS files under a directory
+tree. Only the HEADER and TEXT segments of each file are parsed, so files
+can be found by keyword, channel name or event count without decoding any
+DATA segments.
+
+The catalog is a SQLite database stored next to the data, or held in memory
+if the data directory can not be written. Refreshing it only re-parses files
+whose size or modification time changed; files that can not be parsed are
+recorded as such, so they are not parsed again until they change.
+
+@author: Shareef Dabdoub
+@organization: The Ohio State University
+@organization: Nationwide Children's Hospital
+"""
+from data.IO.fcs import probeFCS
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+CATALOG_NAME = '.find_catalog.sqlite'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path     TEXT PRIMARY KEY,
+    size     INTEGER,
+    mtime    REAL,
+    hash     TEXT,
+    events   INTEGER,
+    channels TEXT,
+    date     TEXT,
+    failed   INTEGER DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS keywords (
+    path  TEXT,
+    key   TEXT,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS keywords_path ON keywords (path);
+CREATE INDEX IF NOT EXISTS keywords_key ON keywords (key);
+"""
+
+
+class FCSCatalog(object):
+    """
+    An index of the FCS files found under a root directory.
+    
+    A catalog may be refreshed on a worker thread, as long as it is not used
+    by another thread until the refresh is done.
+    """
+    def __init__(self, root, dbpath=None):
+        """
+        :@type root: str
+        :@param root: The directory tree to index.
+        :@type dbpath: str
+        :@param dbpath: The catalog database file. Defaults to a file named
+                        CATALOG_NAME in the root directory. If it can not be
+                        opened or created, the catalog is kept in memory 
+                        (and Persistent is False).
+        """
+        self.root = os.path.abspath(root)
+        self.dbpath = dbpath if dbpath is not None else os.path.join(self.root, CATALOG_NAME)
+        self._cancelled = threading.Event()
+        try:
+            self._db = self._open(self.dbpath)
+        except sqlite3.DatabaseError:
+            # e.g. a read-only data directory
+            self.dbpath = ':memory:'
+            self._db = self._open(self.dbpath)
+    
+    
+    @staticmethod
+    def _open(dbpath):
+        db = sqlite3.connect(dbpath, check_same_thread=False)
+        try:
+            db.executescript(_SCHEMA)
+            # catalogs created before parse failures were recorded
+            columns = [row[1] for row in db.execute('PRAGMA table_info(files)')]
+            if 'failed' not in columns:
+                db.execute('ALTER TABLE files ADD COLUMN failed INTEGER DEFAULT 0')
+                db.commit()
+        except sqlite3.DatabaseError:
+            db.close()
+            raise
+        return db
+    
+    
+    @property
+    def Persistent(self):
+        """Whether the catalog is stored on disk."""
+        return self.dbpath != ':memory:'
+
+
+    def close(self):
+        self._db.close()
+    
+    
+    def cancel(self):
+        """
+        Stop a refresh in progress (on another thread) after the current file.
+        """
+        self._cancelled.set()
+
+
+    def refresh(self, progress=None):
+        """
+        Bring the catalog up to date with the directory tree. Files are only
+        probed if they are new or their size or modification time changed.
+
+        :@type progress: callable
+        :@param progress: Optional function called with the number of files
+                          examined so far and the path of the current file.
+        :@rtype: tuple
+        :@return: The number of files (probed, removed). If the refresh is 
+                  cancelled, the files examined so far are kept, and none 
+                  are removed.
+        """
+        self._cancelled.clear()
+        known = dict([(row[0], (row[1], row[2])) for row in
+                      self._db.execute('SELECT path, size, mtime FROM files')])
+        seen = set()
+        probed = 0
+
+        for dirpath, _, filenames in os.walk(self.root):
+            if self._cancelled.is_set():
+                self._db.commit()
+                return (probed, 0)
+            for fname in filenames:
+                if not fname.lower().endswith('.fcs'):
+                    continue
+                path = os.path.join(dirpath, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                seen.add(path)
+                if progress is not None:
+                    progress(len(seen), path)
+                if known.get(path) == (st.st_size, st.st_mtime):
+                    continue
+
+                try:
+                    self._index(path, st)
+                except Exception:
+                    # unreadable or malformed files are recorded as such, so
+                    # they are left out of searches and not probed again
+                    self._remove(path)
+                    self._db.execute('INSERT INTO files (path, size, mtime, failed) VALUES (?, ?, ?, 1)',
+                                     (path, st.st_size, st.st_mtime))
+                    continue
+                probed += 1
+
+        removed = [path for path in known if path not in seen]
+        for path in removed:
+            self._remove(path)
+
+        self._db.commit()
+        return (probed, len(removed))
+
+
+    def _index(self, path, st):
+        """Probe a single file and replace its catalog entries."""
+        channels, ann = probeFCS(path)
+        text = ann['text']
+
+        self._remove(path)
+        self._db.execute('INSERT INTO files (path, size, mtime, hash, events, channels, date) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (path, st.st_size, st.st_mtime,
+                          headHash(path, ann['header']['text_stop']+1, st.st_size),
+                          int(text.get('tot', 0)), json.dumps(channels),
+                          text.get('date', '')))
+        self._db.executemany('INSERT INTO keywords VALUES (?, ?, ?)',
+                             [(path, key, _unicode(value)) for key, value in text.iteritems()])
+
+
+    def _remove(self, path):
+        self._db.execute('DELETE FROM files WHERE path = ?', (path,))
+        self._db.execute('DELETE FROM keywords WHERE path = ?', (path,))
+
+
+    def search(self, keyword=None, value='', channel=None):
+        """
+        Find the cataloged files matching all of the given criteria.
+
+        :@type keyword: str
+        :@param keyword: A TEXT keyword the file must contain (without the $
+                         prefix, case insensitive). If None, the value is
+                         matched against all keywords.
+        :@type value: str
+        :@param value: A substring the keyword value must contain.
+        :@type channel: str
+        :@param channel: A substring of one of the channel names.
+        :@rtype: list
+        :@return: A list of dicts with the path, events, channels and date
+                  of each matching file, sorted by path.
+        """
+        query = 'SELECT path, events, channels, date FROM files WHERE failed = 0'
+        args = []
+        if keyword or value:
+            query += ' AND path IN (SELECT path FROM keywords WHERE value LIKE ?'
+            args.append('%' + value + '%')
+            if keyword:
+                query += ' AND key = ?'
+                args.append(keyword.lower().lstrip('$'))
+            query += ')'
+        if channel:
+            query += ' AND channels LIKE ?'
+            args.append('%' + channel + '%')
+        query += ' ORDER BY path'
+
+        return [{'path': row[0], 'events': row[1],
+                 'channels': json.loads(row[2]), 'date': row[3]}
+                for row in self._db.execute(query, args)]
+
+
+    def keywords(self, path):
+        """
+        :@rtype: dict
+        :@return: The TEXT keywords recorded for the given file.
+        """
+        return dict(self._db.execute('SELECT key, value FROM keywords WHERE path = ?',
+                                     (os.path.abspath(path),)).fetchall())
+
+
+
+def headHash(path, length, size):
+    """
+    Compute a content hash for a FCS file from its HEADER and TEXT segments
+    (the first length bytes) and its total size. This identifies a file's
+    contents without reading its DATA segment.
+
+    :@rtype: str
+    :@return: The hex digest of the hash.
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        h.update(fh.read(length))
+    h.update(str(size))
+    return h.hexdigest()
+
+
+def _unicode(value):
+    """TEXT values may contain bytes in any encoding; store them losslessly."""
+    if isinstance(value, unicode):
+        return value
+    return value.decode('latin-1')
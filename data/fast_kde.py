@@ -38,7 +38,7 @@ def fast_kde(x, y, gridsize=(200, 200), extents=None, nocorrelation=False, weigh
         A gridded 2D kernel density estimate of the input points. 
     """
     #---- Setup --------------------------------------------------------------
-    x, y = np.asarray(x), np.asarray(y)
+    x, y = np.asarray(x, dtype=np.float), np.asarray(y, dtype=np.float)
     x, y = np.squeeze(x), np.squeeze(y)
     
     if x.size != y.size:
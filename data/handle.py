@@ -1,6 +1,8 @@
 """
 This module contains various methods for handling FACS data.
 """
+from data.lazy import LazyData
+
 import math
 import numpy
 
@@ -22,6 +24,32 @@ def filterData(data, selDims):
     
     
 
+def compactData(data):
+    """
+    Convert a data set to the smallest type that holds its values: the 
+    smallest integer type if all values are integers, or otherwise 32-bit 
+    floats (the precision of FCS float data).
+    
+    @type data: numpy.ndarray
+    @var data: An m x n data set
+    
+    @rtype: numpy.ndarray
+    @return: The data set in the compact type, or the original array if it 
+             is already of that type.
+    """
+    if data.size == 0 or data.dtype.kind not in 'fiu':
+        return data
+    
+    if data.dtype.kind == 'f' and not numpy.array_equal(data, numpy.floor(data)):
+        return data.astype(numpy.float32) if data.dtype.itemsize > 4 else data
+    
+    dtype = numpy.result_type(numpy.min_scalar_type(int(data.min())), 
+                              numpy.min_scalar_type(int(data.max())))
+    if dtype.kind not in 'iu':
+        return data
+    return data.astype(dtype) if dtype != data.dtype else data
+    
+
 def reorderColumns(data, columnOrder):
     """
     Given an m x n data set, rearrange the n columns to the specified order.
@@ -36,6 +64,9 @@ def reorderColumns(data, columnOrder):
     @rtype: numpy.ndarray
     @return: The column-reordered data set 
     """
+    if isinstance(data, LazyData):
+        return data.reorder(columnOrder)
+    
     rows = len(data)
     cols = len(data[0])
     
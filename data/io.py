@@ -1,13 +1,21 @@
 """
 """
-from data.store import DataStore, FacsData, FigureStore, Figure
+from data.cache import DataCache
+from data.lazy import IndexedData, LazyData
+from data.project import encode, isProjectFile, ProjectFile, ProjectFileArrays, writeProject
+from data.store import DataStore, FacsData, FigureStore, Figure, LazyClustering
 from IO import fcs
-from error import UnknownFileType 
+from error import UnknownFileType, warnUser
 
+import data.handle as dh
 import numpy as np
 import wx
 
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import json
 import os
+import threading
 
 FILE_INPUT = True
 FILE_OUTPUT = False
@@ -15,25 +23,385 @@ FILE_OUTPUT = False
 methods = {}
 methods['fcs'] = ('fcs', wx.NewId(), fcs.FCSreader, False)
 
-def loadDataFile(filename, window=None):
+def getFileType(filename):
+    """
+    Determine the key of the I/O method for a file: the longest of its 
+    extensions, which may be compound (e.g. csv.gz), with a method.
+    
+    @type filename: string
+    @var filename: The path to a data file.
+    @rtype: str
+    """
+    parts = os.path.basename(filename).split('.')[1:]
+    for i in range(len(parts)):
+        if '.'.join(parts[i:]) in methods:
+            return '.'.join(parts[i:])
+    return parts[-1] if parts else ''
+
+
+def loadDataFile(filename, window=None, **kwargs):
     """
     Loads the given file by choosing the appropriate loading method, 
     and returns a tuple containing the column labels and the data matrix.
     
+    Files read by non-interactive methods are cached (see 
+    L{data.cache.DataCache}), and reopening a cached file maps its decoded 
+    events read-only from the cache instead of parsing the file again. The entry
+    is written in the background after a file is first opened.
+    Memory-mapped loads (mmap=True) bypass the cache, since looking a file up
+    reads all of it to hash its contents.
+    
     @type filename: string
     @var filename: The path to a Flow Cytometry data file.
+    @type kwargs: dict
+    @var kwargs: Loading options passed on to the input method, such as 
+                 mmap=True to request memory-mapped, lazily decoded events, 
+                 or preview=N to read only the first N events. 
+                 Options a method does not support are ignored.
     @rtype: tuple
     @return: The column labels and the event data in a tuple.
     """
-    fileType = filename.split('.')[-1]
+    fileType = getFileType(filename)
     
     if (fileType in methods):
         c = methods[fileType][2](filename, window=window)
-        return c.register()[FILE_INPUT]()
+        if (not DataCache.enabled or isInteractive(filename) or 
+            kwargs.get('preview') is not None or kwargs.get('mmap')):
+            return c.register()[FILE_INPUT](**kwargs)
+        
+        result = DataCache.lookup(filename, kwargs)
+        if result is None:
+            result = c.register()[FILE_INPUT](**kwargs)
+            # lazily decoded (memory-mapped) data is not worth decoding just to cache
+            if result is not None and isinstance(result[1], np.ndarray):
+                DataCache.store(filename, kwargs, *result)
+        return result
     
     raise UnknownFileType(filename)
 
 
+def sourceReference(filename, columns=None, **kwargs):
+    """
+    Describe the data file a data set was loaded from, so that a project can
+    reload the events from it rather than storing a copy (see L{findSource}).
+    
+    @type filename: str
+    @param filename: The path to the data file.
+    @type columns: list
+    @param columns: The order the columns were rearranged to after loading,
+                    or None.
+    @type kwargs: dict
+    @param kwargs: The loading options passed to loadDataFile.
+    @rtype: dict
+    @return: The path, size, modification time and content hash of the 
+             file, the columns and the loading options. The hash is None for
+             memory-mapped loads, which are not meant to read the whole file;
+             the mmap option is kept so that the file is mapped again (and 
+             not hashed) when it is reloaded.
+    """
+    st = os.stat(filename)
+    return {'path': os.path.abspath(filename),
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'hash': None if kwargs.get('mmap') else DataCache.contentHash(filename),
+            'columns': list(columns) if columns is not None else None,
+            'options': dict([(k, v) for k, v in kwargs.iteritems() 
+                             if k != 'preview'])}
+
+
+def findSource(ref, dir=None):
+    """
+    Locate the unchanged data file described by a source reference: at its
+    recorded path, or with the same name in the given directory (so a 
+    project can be moved along with its data files). Files are compared by
+    content hash, or by size and modification time if the hash was not 
+    recorded.
+    
+    @type ref: dict
+    @param ref: A source reference created by L{sourceReference}.
+    @type dir: str
+    @param dir: A directory to look in if the file is not at its path.
+    @rtype: str
+    @return: The path to the file, or None if it is missing or has changed.
+    """
+    for path in sourcePaths(ref, dir):
+        try:
+            st = os.stat(path)
+            if st.st_size != ref['size']:
+                continue
+            if ref['hash'] is None:
+                if st.st_mtime == ref.get('mtime'):
+                    return path
+            elif DataCache.contentHash(path) == ref['hash']:
+                return path
+        except (IOError, OSError):
+            continue
+
+
+def sourcePaths(ref, dir=None):
+    """
+    @rtype: list
+    @return: The paths at which L{findSource} looks for a referenced file.
+    """
+    paths = [ref['path']]
+    if dir is not None:
+        paths.append(os.path.join(dir, os.path.basename(ref['path'])))
+    return paths
+
+
+def loadSource(ref, dir=None):
+    """
+    Reload the events of a data set from its source data file.
+    
+    @type ref: dict
+    @param ref: A source reference created by L{sourceReference}.
+    @rtype: numpy.ndarray
+    @return: The events, or None if the file is missing or has changed.
+    """
+    path = findSource(ref, dir)
+    if path is None:
+        return None
+    result = loadDataFile(path, **ref['options'])
+    if result is None:
+        return None
+    data = result[1]
+    if ref['columns'] is not None:
+        data = dh.reorderColumns(data, ref['columns'])
+    return data
+
+
+class SourceFileData(LazyData):
+    """
+    The events of a data set saved in a project as a reference to its data 
+    file (see L{sourceReference}), which are read from the file only when 
+    first needed. The file is also only checked against the reference 
+    then, as that may read all of it.
+    
+    If the file is missing or has changed, the data set is unavailable: the 
+    user is warned, and its events are all NaN. The reference is kept, so
+    the events are read again once the file is placed beside the project.
+    """
+    def __init__(self, ref, shape, dir=None, status=None):
+        """
+        @type ref: dict
+        @param ref: A source reference created by L{sourceReference}.
+        @type shape: tuple
+        @param shape: The (events, channels) dimensions of the data.
+        @type dir: str
+        @param dir: The project directory, also searched for the file.
+        @type status: callable
+        @param status: Optional function called with a message while the 
+                       file is being read, and with '' when it is done. It
+                       is always called on the GUI thread, so it may use wx
+                       even when the file is read by a worker (e.g. a 
+                       L{ProjectSaver}).
+        """
+        self.ref = ref
+        self._shape = tuple(shape)
+        self.dir = dir
+        self.status = status
+        self._data = None
+        self.available = True
+    
+    @property
+    def shape(self):
+        return self._shape
+    
+    @property
+    def Loaded(self):
+        """Whether the events have been read from the file."""
+        return self._data is not None and self.available
+    
+    def exists(self):
+        """
+        A quick check that a file with the referenced name is present, 
+        without checking its contents.
+        """
+        return any([os.path.exists(path) for path in sourcePaths(self.ref, self.dir)])
+    
+    def materialize(self):
+        if self._data is None and self.available:
+            name = os.path.basename(self.ref['path'])
+            self.report('Loading %s...' % name)
+            self._data = loadSource(self.ref, self.dir)
+            self.report('')
+            if self._data is None:
+                self.available = False
+                warnUser('The data file \'%s\' is missing or has changed, so its events are not available. '
+                         'Place the original file beside the project and open the project again.' % self.ref['path'],
+                         'Data File Unavailable')
+        if self._data is None:
+            self._data = np.empty(self.shape, dtype=np.float32)
+            self._data.fill(np.nan)
+        return self._data
+    
+    def report(self, message):
+        """Pass a message to the status function on the GUI thread."""
+        if self.status is None:
+            return
+        if wx.Thread_IsMain():
+            self.status(message)
+        else:
+            wx.CallAfter(self.status, message)
+
+
+def isInteractive(filename):
+    """
+    Determine whether the input method for the given file needs to interact
+    with the user, and so must be run on the GUI thread.
+    
+    @type filename: string
+    @var filename: The path to a Flow Cytometry data file.
+    @rtype: bool
+    """
+    fileType = getFileType(filename)
+    return fileType in methods and getattr(methods[fileType][2], 'interactive', False)
+
+
+def countDataSets(filename):
+    """
+    Determine the number of data sets stored in the given file. Only input 
+    methods providing a countDataSets method (such as the FCS reader, for 
+    files chained by \$NEXTDATA) report more than one; each data set can then
+    be loaded by passing its index to loadDataFile as the dataset option.
+    
+    @type filename: string
+    @var filename: The path to a Flow Cytometry data file.
+    @rtype: int
+    """
+    fileType = getFileType(filename)
+    if fileType not in methods:
+        raise UnknownFileType(filename)
+    count = getattr(methods[fileType][2], 'countDataSets', None)
+    if count is None:
+        return 1
+    return count(methods[fileType][2](filename))
+
+
+class FileLoader(object):
+    """
+    Loads a set of data files on a pool of worker threads, handing back the 
+    results in the order the files were given. Files whose input method is 
+    interactive are loaded on the calling thread when their turn comes, 
+    while the remaining files continue to load in the background.
+    
+    Files containing several data sets (see countDataSets) are split into
+    one task per data set, so their data sets are decoded in parallel too.
+    """
+    def __init__(self, paths, window=None, workers=None, **kwargs):
+        """
+        @type paths: list
+        @param paths: The paths of the data files to load.
+        @type window: wx.Window
+        @param window: The parent window for interactive input methods.
+        @type workers: int
+        @param workers: The number of worker threads. Defaults to the number 
+                        of processors.
+        @type kwargs: dict
+        @param kwargs: Loading options passed on to loadDataFile.
+        """
+        self.paths = list(paths)
+        self.window = window
+        self.kwargs = kwargs
+        self.workers = workers if workers is not None else cpu_count()
+        self._cancelled = threading.Event()
+        self._pool = None
+        self._pending = None
+        self._tasks = None
+    
+    def start(self):
+        """
+        Begin decoding the files in the background. This is done by 
+        results() if it has not been called already.
+        """
+        if self._pool is not None:
+            return
+        self._tasks = []
+        for n, path in enumerate(self.paths):
+            try:
+                count = 1 if isInteractive(path) else countDataSets(path)
+            except Exception:
+                # the error is reported when the file itself is loaded
+                count = 1
+            if count == 1:
+                self._tasks.append((n, path, None))
+            else:
+                self._tasks.extend([(n, path, i) for i in range(count)])
+        
+        self._pool = ThreadPool(max(1, min(self.workers, len(self._tasks))))
+        self._pending = [None if isInteractive(path) else 
+                         self._pool.apply_async(self._load, (path, dataset)) 
+                         for n, path, dataset in self._tasks]
+    
+    def cancel(self):
+        """
+        Abort loading: files not yet started are skipped, and the results of
+        any files still being decoded are discarded.
+        """
+        self._cancelled.set()
+    
+    @property
+    def Cancelled(self):
+        return self._cancelled.is_set()
+    
+    def _load(self, path, dataset=None):
+        if self.Cancelled:
+            return
+        if dataset is None:
+            return loadDataFile(path, **self.kwargs)
+        return loadDataFile(path, dataset=dataset, **self.kwargs)
+    
+    def results(self, poll=None, interval=0.1):
+        """
+        Generate the loaded data sets in order as they become available.
+        
+        @type poll: callable
+        @param poll: Called as poll(n, path) periodically while waiting for 
+                     the nth file to finish loading. If it returns False, 
+                     loading is cancelled.
+        @type interval: float
+        @param interval: The number of seconds between calls to poll.
+        @rtype: generator
+        @return: (n, path, result) tuples, where n is the index of the file
+                 in paths and result is the value returned by loadDataFile,
+                 or the exception raised if loading failed; files with 
+                 several data sets generate one tuple for each.
+        """
+        self.start()
+        pending = self._pending
+        complete = False
+        try:
+            for t, (n, path, dataset) in enumerate(self._tasks):
+                if self.Cancelled:
+                    return
+                if pending[t] is None:
+                    try:
+                        result = loadDataFile(path, window=self.window, **self.kwargs)
+                    except Exception, err:
+                        result = err
+                    yield (n, path, result)
+                    continue
+                
+                while not pending[t].ready():
+                    if poll is not None and poll(n, path) is False:
+                        self.cancel()
+                        return
+                    pending[t].wait(interval)
+                try:
+                    result = pending[t].get()
+                except Exception, err:
+                    result = err
+                yield (n, path, result)
+            complete = True
+        finally:
+            # if loading was stopped early, queued files see the cancellation 
+            # and return immediately; files already being decoded finish in 
+            # the background and are discarded
+            if not complete:
+                self.cancel()
+            self._pool.close()
+
+
 def exportDataFile(eID, filename, fcData, window=None):
     """
     Passes the given FacsData instance to the specified IO class.
@@ -107,16 +475,16 @@ def strID(methodID):
 
 
 import shelve
-def saveState(dir, filename):
+def saveState(dir, filename, progress=None):
     """
     Save a representation of the system state: All the loaded data sets, 
     their clusterings, any transformations or analyses (future), 
     and all plots.
     
-    The state is saved in JSON format based on a dict of the following form:
+    The state is saved in a single project file (see L{data.project}), with 
+    the settings in JSON format based on a dict of the following form:
     
     data: list of IDs
-    binfile: the filename of the binary file used to store all the actual data
     data-dID: dict of settings belonging to a FacsData instance
     clust-dID-cID: a dict of attributes belonging to a clustering
     figures: list of figureID strings
@@ -125,22 +493,67 @@ def saveState(dir, filename):
     fig-ID-p-ID: A dict for each subplot in each figure keyed on fig ID and plot ID.
     current-data: data ID
     current-figure: figure ID
+    
+    The actual numeric data are stored as arrays in the same file, keyed on
+    content hash so that only new or changed arrays are written. The events
+    of data sets loaded from unchanged data files are not stored, but 
+    reloaded from the files (see L{sourceReference}).
+    
+    @type progress: callable
+    @param progress: Optional function called as progress(stage, fraction)
+                     while the file is written (see L{writeProject}).
     """ 
-    store = shelve.open(os.path.join(dir, filename))
-    #store = dbopen(os.path.join(dir, filename), 'c', format='csv')
-    # The actual numeric data will be stored in a separate binary file using
-    # the numpy savez() method allowing for efficient storage/retrieval of data
-    binfile = '%s.npz' % filename
+    entries, arrays, sources = snapshotState(filename)
+    checkSources(entries, arrays, sources, dir, progress)
+    writeProject(os.path.join(dir, filename), entries, arrays, progress)
+
+
+def snapshotState(filename):
+    """
+    Take a copy of the system state for saveState. The settings are copied 
+    (converted for the project file), and the arrays are referred to as 
+    they are now. Hashing and reading the arrays are left to the functions
+    returned, so the snapshot is cheap to take, and can be written on 
+    another thread while the state continues to change.
+    
+    @type filename: str
+    @param filename: The name of the project file, recorded as the file name
+                     of data sets without one.
+    @rtype: tuple
+    @return: The settings entries, the (hash function, array function) 
+             pairs of the arrays, keyed on name, and the data sets that 
+             refer to their data files, to be checked by L{checkSources}.
+    """
+    store = {}
+    # the values are (hash, function returning the array) 
     bindata = {}
+    # the values are (source reference, (hash, function returning the array))
+    sources = {}
     
     store['data'] = DataStore.getData().keys()
-    store['binfile'] = binfile
     for dID in DataStore.getData():
         fdata = DataStore.get(dID)
         dStr = 'data-%i' % dID
-        dfname = fdata.filename if (fdata.filename is not '') else binfile
-        bindata[dStr] = fdata.data
+        dfname = fdata.filename if (fdata.filename is not '') else filename
+        # derived data sets only store the indices of their events, and data
+        # sets still matching their data file only a reference to the file.
+        # Events that have not been read from a project's data file (or could
+        # not be) exist only in the file, so the reference is always kept.
+        source = None
+        sourceFile = None
+        if isinstance(fdata.Source, IndexedData):
+            source = fdata.Source.source.ID
+            bindata['rows-%i' % dID] = fdata.savedArray()
+        elif fdata.sourceFile is not None:
+            sourceFile = fdata.sourceFile
+            if not (isinstance(fdata.Source, SourceFileData) and not fdata.Source.Loaded):
+                sources[dStr] = (sourceFile, fdata.savedArray())
+        else:
+            bindata[dStr] = fdata.savedArray()
         store[dStr] = {'filename':     dfname,
+                       'source':       source,
+                       'sourceFile':   sourceFile,
+                       'shape':        (fdata.EventCount, len(fdata.labels)),
                        'displayname':  fdata.displayname, 
                        'labels':       fdata.labels, 
                        'annotations':  fdata.annotations, 
@@ -160,7 +573,10 @@ def saveState(dir, filename):
                      'clusteringSelDims': fdata.clusteringSelDims[cID],
                      'infoExpanded':      fdata.infoExpanded[cID]}
             store[cStr] = csett
-            bindata[cStr] = fdata.clustering[cID]
+            # clusterings not used since the project was loaded are saved 
+            # without converting them
+            clustering = fdata.clustering.peek(cID)
+            bindata[cStr] = (lambda c=clustering: c.Hash, lambda c=clustering: np.asarray(c))
     
     
     # figures
@@ -180,49 +596,193 @@ def saveState(dir, filename):
     store['current-data'] = DataStore.getCurrentIndex()
     store['current-figure'] = FigureStore.getSelectedIndex()
     
-    # write out settings data
-    store.close()
-    # write out numeric data to binary file
-    np.savez(os.path.join(dir, binfile), **bindata)
+    return encode(store), bindata, sources
+
+
+def checkSources(entries, arrays, sources, dir=None, progress=None):
+    """
+    Check the data files referred to by a snapshot of the state (see 
+    L{snapshotState}), and store the events of the data sets whose files 
+    are missing or have changed in the project instead. As this may read 
+    the files in full, L{ProjectSaver} runs it on its thread.
+    
+    @type dir: str
+    @param dir: The project directory, also searched for the files.
+    @type progress: callable
+    @param progress: Optional function called as progress('checking', fraction).
+    """
+    for i, dStr in enumerate(sorted(sources)):
+        if progress is not None:
+            progress('checking', float(i) / len(sources))
+        ref, array = sources[dStr]
+        if findSource(ref, dir) is None:
+            entries[dStr]['sourceFile'] = None
+            arrays[dStr] = array
+
+
+class ProjectSaver(object):
+    """
+    Saves the system state to a project file on a background thread.
+    
+    The state is copied when the saver is created (see L{snapshotState}), 
+    so it can continue to change while the file is written. The save is 
+    only committed once it is complete (see L{writeProject}), so the 
+    previous project is left intact if it fails.
+    
+    Progress and the outcome are read from the Progress, Done and Error 
+    properties, which the calling (GUI) thread can poll.
+    """
+    def __init__(self, dir, filename):
+        """
+        @type dir: str
+        @param dir: The directory to save the project in.
+        @type filename: str
+        @param filename: The name of the project file (.find)
+        """
+        self.dir = dir
+        self.path = os.path.join(dir, filename)
+        self.entries, self.arrays, self.sources = snapshotState(filename)
+        self._progress = ('checking', 0.0)
+        self._error = None
+        # not a daemon, so exiting the application waits for the save
+        self._thread = threading.Thread(target=self._run)
+    
+    def start(self):
+        """
+        Begin writing the project file.
+        """
+        self._thread.start()
+    
+    def _run(self):
+        try:
+            checkSources(self.entries, self.arrays, self.sources, self.dir, self._update)
+            writeProject(self.path, self.entries, self.arrays, self._update)
+        except Exception, err:
+            self._error = err
+    
+    def _update(self, stage, fraction):
+        self._progress = (stage, fraction)
+    
+    @property
+    def Progress(self):
+        """The (stage, fraction) progress of the save."""
+        return self._progress
+    
+    @property
+    def Done(self):
+        return self._thread.ident is not None and not self._thread.is_alive()
+    
+    @property
+    def Error(self):
+        """The exception that ended the save, or None."""
+        return self._error
+
+
+class ProjectArrays(object):
+    """
+    Read access, by name, to the arrays of a project saved in the earlier
+    format of a shelve with a JSON manifest of .npy files named by content
+    hash. Each array is memory-mapped from its file when requested.
+    """
+    def __init__(self, dir, manifest):
+        """
+        @raise IOError: If the manifest can not be read.
+        @raise ValueError: If the manifest is not valid JSON.
+        """
+        self.dir = dir
+        with open(os.path.join(dir, manifest), 'r') as fh:
+            self.files = json.load(fh)['arrays']
+    
+    def __contains__(self, name):
+        return name in self.files
+    
+    def __getitem__(self, name):
+        return np.load(os.path.join(self.dir, self.files[name]), mmap_mode='r')
+    
+    def hash(self, name):
+        """The content hash of an array, which names its file."""
+        return os.path.splitext(os.path.basename(self.files[name]))[0]
     
 
 from error import ProjectLoadingError
 from zipfile import BadZipfile
-def loadState(dir, filename):
+def loadState(dir, filename, status=None):
     """
     Restore the system state as stored to disk.
     
+    Only the settings are read up front. The arrays of projects are 
+    memory-mapped, and data sets saved as references to their data files 
+    are read from the files when first used. Projects saved in the earlier
+    shelve formats, with the arrays in a .npz file or in .npy files, are
+    also read.
+    
     @type dir: string
     @param path: The directory under which the the saved system state is stored
     @type filename: str
     @param filename: The name of the saved project file (.find)
+    @type status: callable
+    @param status: Optional function called with a message when the events 
+                   of a data set are being read.
     @rtype: tuple
     @return: A list of subplot settings (dicts) retrieved from the file,
              The index of the currently selected subplot,
              The currently selected axes,
              The number of rows and columns in the figure (grid size)
     """
-    store = shelve.open(os.path.join(dir, filename))
-    #store = dbopen(os.path.join(dir, filename))
-    datakeys = store['data']
+    path = os.path.join(dir, filename)
+    if isProjectFile(path):
+        try:
+            store = ProjectFile(path)
+        except (IOError, ValueError, KeyError), err:
+            wx.MessageBox('The file \'%s\' may have become corrupted. Project loading has been cancelled' % path,
+                          'Data Loading Error',
+                          wx.OK|wx.ICON_ERROR)
+            raise ProjectLoadingError('%s: %s' % (err.__class__.__name__, path))
+        return _loadState(dir, store, store.arrays, status)
     
+    store = shelve.open(path)
+    #store = dbopen(os.path.join(dir, filename))
     try:
-        bindata = np.load(os.path.join(dir,store['binfile']))
+        if store['binfile'].endswith('.json'):
+            bindata = ProjectArrays(dir, store['binfile'])
+        else:
+            bindata = np.load(os.path.join(dir,store['binfile']))
     except IOError:
         bindata = None
-    except BadZipfile:
+    except (BadZipfile, ValueError, KeyError), err:
         wx.MessageBox('The file \'%s\' may have become corrupted. Project loading has been cancelled' % store['binfile'],
                       'Data Loading Error',
                       wx.OK|wx.ICON_ERROR)
-        raise ProjectLoadingError('BadZipfile: %s' % os.path.join(dir,store['binfile']))
+        raise ProjectLoadingError('%s: %s' % (err.__class__.__name__, os.path.join(dir,store['binfile'])))
+    return _loadState(dir, store, bindata, status)
+
+
+def _loadState(dir, store, bindata, status=None):
+    """
+    Restore the data sets and figures of a project from its settings and 
+    arrays, as opened by loadState.
+    """
+    datakeys = store['data']
+    missing = []
     
-    # Parse data sets
-    for dID in datakeys:
+    # Parse data sets, in order so that sources are loaded before the data 
+    # sets derived from them
+    for dID in sorted(datakeys):
         dStr = 'data-%s' % dID
         dsett = store[dStr]
         ann = dsett['annotations'] if 'annotations' in dsett else {}
         ana = dsett['analysis'] if 'analysis' in dsett else {}
-        fdata = FacsData(dsett['filename'], dsett['labels'], bindata[dStr], 
+        if dsett.get('source') is not None:
+            data = IndexedData(DataStore.get(dsett['source']), bindata['rows-%s' % dID])
+        elif dsett.get('sourceFile') is not None:
+            # the file is compared to the reference when its events are read
+            data = SourceFileData(dsett['sourceFile'], dsett['shape'], dir, status)
+            if not data.exists():
+                data.available = False
+                missing.append(dsett['sourceFile']['path'])
+        else:
+            data = bindata[dStr]
+        fdata = FacsData(dsett['filename'], dsett['labels'], data, 
                          annotations=ann, analysis=ana,
                          parent=dsett['parent'])
         fdata.displayname = dsett['displayname']
@@ -230,16 +790,29 @@ def loadState(dir, filename):
         fdata.children = dsett['children']
         fdata.selDims = dsett['selDims']
         fdata.nodeExpanded = dsett['nodeExpanded']
-        # Parse clusterings
+        fdata.sourceFile = dsett.get('sourceFile')
+        # the array files are named by content hash
+        hashed = isinstance(bindata, (ProjectArrays, ProjectFileArrays))
+        if hashed:
+            for name in ['rows-%s' % dID, dStr]:
+                if name in bindata:
+                    fdata.DataHash = bindata.hash(name)
+        # Parse clusterings; each is converted when first used
         for cID in dsett['clustering']:
             cStr = 'clust-%i-%i' % (dID, cID)
             csett = store[cStr]
-            clusterIDs = bindata[cStr]
+            clusterIDs = LazyClustering(bindata[cStr], 
+                                        bindata.hash(cStr) if hashed else None)
             fdata.addClustering(csett['method'], clusterIDs, csett['opts'], cID)
             fdata.clusteringSelDims[cID] = csett['clusteringSelDims']
             fdata.infoExpanded[cID] = csett['infoExpanded']
         
         DataStore.add(fdata)
+    
+    if missing:
+        warnUser('The following data files are missing, so the events of their data sets are not available:\n\n%s\n\n'
+                 'Place the files beside the project and open the project again.' % '\n'.join(missing),
+                 'Data Files Missing')
         
     DataStore.selectDataSet(store['current-data'])
 
@@ -0,0 +1,123 @@
+"""
+This module contains the base class for event data that is loaded or
+decoded on demand rather than when a data set is first opened.
+
+@author: Shareef Dabdoub
+@organization: The Ohio State University
+@organization: Nationwide Children's Hospital
+"""
+import numpy
+
+
+class LazyData(object):
+    """
+    A LazyData instance can be handed to a FacsData in place of an array.
+    The events are not read until a plot, transform or clustering touches
+    them, and then only the requested columns are decoded where possible.
+
+    Subclasses must implement the shape property and the materialize method.
+    Overriding columns() and rows() allows partial access without decoding
+    the entire data set.
+    
+    The materialized events are kept by the FacsData unless cache is False,
+    in which case they are materialized again on each access.
+    """
+    cache = True
+    
+    @property
+    def shape(self):
+        """
+        :@rtype: tuple
+        :@return: The (events, channels) dimensions of the data.
+        """
+        pass
+
+    def __len__(self):
+        return self.shape[0]
+
+    def materialize(self):
+        """
+        Decode and return all of the event data.
+
+        :@rtype: numpy.ndarray
+        :@return: An m x n array of the full data set.
+        """
+        pass
+
+    def columns(self, dims):
+        """
+        Retrieve only the specified columns of the data.
+
+        :@type dims: list
+        :@param dims: The indices of the desired columns.
+        :@rtype: numpy.ndarray
+        :@return: An m x len(dims) array.
+        """
+        return self.materialize()[:, dims]
+
+    def rows(self, start, stop):
+        """
+        Retrieve a contiguous range of events.
+
+        :@rtype: numpy.ndarray
+        :@return: An (stop-start) x n array.
+        """
+        return self.materialize()[start:stop]
+
+    def reorder(self, columnOrder):
+        """
+        Rearrange the columns of the data to the specified order.
+
+        :@type columnOrder: list
+        :@param columnOrder: The new order of the column indices.
+        :@rtype: LazyData or numpy.ndarray
+        :@return: The reordered data.
+        """
+        data = self.materialize()
+        return numpy.column_stack(tuple([data[:,i] for i in columnOrder]))
+
+
+
+class IndexedData(LazyData):
+    """
+    The events of a derived data set, held as an int32 array of indices of 
+    the rows of its top-level data set rather than as a copy of the events.
+    
+    Events are gathered from the source when accessed and are not kept, so
+    a hierarchy of derived data sets costs only the memory of its indices.
+    """
+    cache = False
+    
+    def __init__(self, source, index):
+        """
+        :@type source: data.store.FacsData
+        :@param source: The top-level data set the rows are selected from.
+        :@type index: array
+        :@param index: The indices of the selected rows of the source.
+        """
+        self.source = source
+        self.index = numpy.asarray(index, dtype=numpy.int32)
+    
+    @property
+    def shape(self):
+        return (len(self.index), len(self.source.labels))
+    
+    def materialize(self):
+        return self.source.data[self.index]
+    
+    def columns(self, dims):
+        return self.source.getColumns(dims)[self.index]
+    
+    def rows(self, start, stop):
+        return self.source.data[self.index[start:stop]]
+    
+    def select(self, rows):
+        """
+        Create a data set of a selection of these events, indexing the same
+        source.
+        
+        :@type rows: array
+        :@param rows: The indices (or a boolean mask) of the selected events.
+        :@rtype: IndexedData
+        """
+        return IndexedData(self.source, self.index[rows])
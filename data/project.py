@@ -0,0 +1,313 @@
+"""
+This module contains the single-file project format. A project file holds
+the settings of each data set, clustering and figure as JSON, along with the
+numeric arrays as raw blocks that can be memory-mapped directly:
+
+    - header: MAGIC, the format version, and the offset and length of the
+      table of contents
+    - arrays: the bytes of each array, starting at a multiple of ALIGN
+    - table of contents: JSON holding the settings entries, and the name,
+      content hash, type, shape and offset of each array
+
+Opening a project reads only the header and the table of contents, and each
+array is then a single seek away. Saving over an existing project appends
+just the arrays it does not already hold and a new table of contents, and
+then commits the save by rewriting the header. Once most of the file is no
+longer used, it is rewritten in full instead.
+
+@author: Shareef Dabdoub
+@organization: The Ohio State University
+@organization: Nationwide Children's Hospital
+"""
+import numpy as np
+
+import base64
+import cPickle
+import json
+import os
+import struct
+
+MAGIC = 'FINDPROJ'
+VERSION = 1
+# magic, version, reserved, table of contents offset and length
+HEADER = struct.Struct('<8sIIQQ')
+ALIGN = 64
+WRITE_BLOCK_BYTES = 16 * 1024**2
+
+
+def isProjectFile(path):
+    """
+    @rtype: bool
+    @return: True if the file at path is in the single-file project format.
+    """
+    try:
+        with open(path, 'rb') as fh:
+            return fh.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+class ProjectFile(object):
+    """
+    Read access to a project file: the settings entries by key, and the
+    arrays through the arrays attribute.
+    """
+    def __init__(self, path):
+        """
+        :@type path: str
+        :@param path: The path to the project file.
+        :@raise IOError: If the file can not be read.
+        :@raise ValueError: If the file is not a valid project file.
+        """
+        self.path = path
+        with open(path, 'rb') as fh:
+            try:
+                magic, version, _, offset, length = HEADER.unpack(fh.read(HEADER.size))
+            except struct.error:
+                raise ValueError('%s is not a project file' % path)
+            if magic != MAGIC:
+                raise ValueError('%s is not a project file' % path)
+            if version > VERSION:
+                raise ValueError('%s was saved by a newer version (%i)' % (path, version))
+            fh.seek(offset)
+            toc = json.loads(fh.read(length))
+        self.entries = toc['entries']
+        self.arrays = ProjectFileArrays(path, toc['arrays'])
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        return decode(self.entries[key])
+
+    def keys(self):
+        return self.entries.keys()
+
+
+class ProjectFileArrays(object):
+    """
+    The arrays of a project file by name, each memory-mapped read-only when
+    requested.
+    """
+    def __init__(self, path, index):
+        """
+        :@type index: dict
+        :@param index: The hash, dtype, shape and offset of each array.
+        """
+        self.path = path
+        self.index = index
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        entry = self.index[name]
+        dtype = np.dtype(str(entry['dtype']))
+        shape = tuple(entry['shape'])
+        # an empty file region can not be mapped
+        if not np.prod(shape):
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode='r',
+                         offset=entry['offset'], shape=shape)
+
+    def hash(self, name):
+        """The content hash of an array."""
+        return self.index[name]['hash']
+
+
+def writeProject(path, entries, arrays, progress=None):
+    """
+    Save a project. If a project file already exists at path and most of it
+    is still in use, only the new arrays and the table of contents are
+    appended, and the save is committed by rewriting the header. Otherwise
+    a new file is written and moved over the old one, or, if the old file
+    can not be replaced (on Windows, while its arrays are mapped), appended
+    to it after all. Either way, the file holds the previous project until 
+    the save is complete.
+
+    :@type path: str
+    :@param path: The path to the project file.
+    :@type entries: dict
+    :@param entries: The settings of the project, converted by L{encode}, 
+                     by key.
+    :@type arrays: dict
+    :@param arrays: (hash, function returning the array) pairs keyed on name.
+                    The hash may also be a function computing it.
+    :@type progress: callable
+    :@param progress: Optional function called as progress(stage, fraction)
+                      while the arrays are hashed ('hashing') and written 
+                      ('writing').
+    """
+    hashed = {}
+    for i, name in enumerate(sorted(arrays)):
+        if progress is not None:
+            progress('hashing', float(i) / len(arrays))
+        hash, getArray = arrays[name]
+        hashed[name] = (hash() if callable(hash) else hash, getArray)
+    arrays = hashed
+
+    old = None
+    if isProjectFile(path):
+        try:
+            old = ProjectFile(path)
+        except (IOError, ValueError):
+            old = None
+
+    if old is not None:
+        blocks = dict([(e['hash'], e) for e in old.arrays.index.values()])
+        hashes = set([hash for hash, _ in arrays.values()])
+        used = sum([_nbytes(e) for h, e in blocks.iteritems() if h in hashes])
+        if used >= (os.path.getsize(path) - HEADER.size) / 2:
+            _append(path, entries, arrays, blocks, progress)
+            return
+
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'wb') as fh:
+            _write(fh, HEADER.size, entries, arrays, {}, progress)
+    except (IOError, OSError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    try:
+        _replace(tmp, path)
+    except OSError:
+        os.remove(tmp)
+        if old is None:
+            raise
+        _append(path, entries, arrays, blocks, progress)
+
+
+def _append(path, entries, arrays, blocks, progress=None):
+    """Append a save to an existing project file (see L{_write})."""
+    with open(path, 'r+b') as fh:
+        fh.seek(0, 2)
+        _write(fh, fh.tell(), entries, arrays, blocks, progress)
+
+
+def _replace(src, dst):
+    """
+    Move the file src over dst. Windows can not rename over an existing 
+    file, so there the old file is first moved aside, and restored if the
+    new one can not be moved into place.
+    
+    :@raise OSError: If dst was not replaced; it is then left unchanged.
+    """
+    if os.name != 'nt' or not os.path.exists(dst):
+        os.rename(src, dst)
+        return
+    aside = dst + '.old'
+    if os.path.exists(aside):
+        os.remove(aside)
+    os.rename(dst, aside)
+    try:
+        os.rename(src, dst)
+    except OSError:
+        os.rename(aside, dst)
+        raise
+    try:
+        os.remove(aside)
+    except OSError:
+        pass
+
+
+def _write(fh, start, entries, arrays, blocks, progress=None):
+    """
+    Write the arrays not already in blocks from position start, followed by
+    the table of contents, and then point the header at it.
+    """
+    index = {}
+    pos = start
+    for i, (name, (hash, getArray)) in enumerate(sorted(arrays.iteritems())):
+        if progress is not None:
+            progress('writing', float(i) / len(arrays))
+        if hash not in blocks:
+            data = np.asarray(getArray())
+            pos += -pos % ALIGN
+            fh.seek(pos)
+            _writeArray(fh, data)
+            blocks[hash] = {'hash': hash, 'offset': pos,
+                            'dtype': data.dtype.str, 'shape': list(data.shape)}
+            pos += data.nbytes
+        index[name] = blocks[hash]
+
+    toc = json.dumps({'version': VERSION, 'entries': entries, 'arrays': index})
+    fh.seek(pos)
+    fh.write(toc)
+    fh.flush()
+    os.fsync(fh.fileno())
+    fh.seek(0)
+    fh.write(HEADER.pack(MAGIC, VERSION, 0, pos, len(toc)))
+    fh.flush()
+    os.fsync(fh.fileno())
+
+
+def _writeArray(fh, data):
+    """Write the bytes of an array in C order, a block of rows at a time."""
+    if data.ndim == 0 or data.flags.c_contiguous:
+        fh.write(np.ascontiguousarray(data).data)
+        return
+    step = max(1, WRITE_BLOCK_BYTES // max(1, data[:1].nbytes))
+    for i in xrange(0, len(data), step):
+        fh.write(np.ascontiguousarray(data[i:i+step]).data)
+
+
+def _nbytes(entry):
+    return int(np.prod(entry['shape'])) * np.dtype(str(entry['dtype'])).itemsize
+
+
+
+#--------------------
+# SETTINGS ENCODING
+#--------------------
+def encode(obj):
+    """
+    Convert settings to values JSON can represent. Values of types JSON does
+    not have (tuples, dicts with keys other than strings, byte strings that
+    are not ASCII, small numpy arrays) are tagged so that L{decode} restores
+    them; any other objects are pickled.
+    """
+    if obj is None or isinstance(obj, (bool, int, long, float, unicode)):
+        return obj
+    if isinstance(obj, str):
+        try:
+            return obj.decode('ascii')
+        except UnicodeDecodeError:
+            return {'__bytes__': base64.b64encode(obj)}
+    if isinstance(obj, list):
+        return [encode(v) for v in obj]
+    if isinstance(obj, tuple):
+        return {'__tuple__': [encode(v) for v in obj]}
+    if isinstance(obj, dict):
+        if all([isinstance(k, basestring) and not k.startswith('__') for k in obj]):
+            return dict([(k, encode(v)) for k, v in obj.iteritems()])
+        return {'__items__': [[encode(k), encode(v)] for k, v in obj.iteritems()]}
+    if isinstance(obj, np.ndarray) and obj.dtype.kind in 'biuf':
+        return {'__ndarray__': [obj.dtype.str, list(obj.shape), obj.ravel().tolist()]}
+    if isinstance(obj, np.generic):
+        return encode(obj.item())
+    return {'__pickle__': base64.b64encode(cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL))}
+
+
+def decode(obj):
+    """
+    Restore settings converted by L{encode}.
+    """
+    if isinstance(obj, list):
+        return [decode(v) for v in obj]
+    if not isinstance(obj, dict):
+        return obj
+    if len(obj) == 1:
+        tag, value = obj.items()[0]
+        if tag == '__bytes__':
+            return base64.b64decode(value)
+        if tag == '__tuple__':
+            return tuple([decode(v) for v in value])
+        if tag == '__items__':
+            return dict([(decode(k), decode(v)) for k, v in value])
+        if tag == '__ndarray__':
+            dtype, shape, values = value
+            return np.array(values, dtype=str(dtype)).reshape(shape)
+        if tag == '__pickle__':
+            return cPickle.loads(base64.b64decode(value))
+    return dict([(k, decode(v)) for k, v in obj.iteritems()])
@@ -6,12 +6,30 @@ This module contains classes used for storing FACS data.
 @organization: Nationwide Children's Hospital
 """
 
+from data.lazy import IndexedData, LazyData
+
+import numpy
+import transforms.methods as tm
+
+from collections import OrderedDict
+import hashlib
 from operator import itemgetter
 
 ID_DATA_ITEM = 0
 ID_CLUSTERING_ITEM = 1
 ID_TRANSFORMATION_ITEM = 2
 
+# the quantiles (as fractions) estimated for each channel by FacsData.Stats
+STATS_QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+# the number of events sampled to estimate quantiles
+STATS_SAMPLE_EVENTS = 100000
+# the number of events summarized at a time
+STATS_BLOCK_EVENTS = 262144
+# the total size of the prepared analysis matrices kept by PreparedDataCache
+PREPARED_MAX_BYTES = 1024**3
+# the number of array elements hashed at a time by arrayHash
+HASH_BLOCK_ITEMS = 1024**2
+
 class DataStore(object):
     """
     DataStore is meant to be used as a pseudo-database of FacsData objects.
@@ -83,6 +101,7 @@ class DataStore(object):
                 pd = cls._facsData[fd.parent]
                 pd.children = [id for id in pd.children if id != index]
             # finally, delete the item itself
+            PreparedDataCache.invalidate(fd)
             del cls._facsData[index]
         
         if len(cls._facsData) > 0:
@@ -96,6 +115,7 @@ class DataStore(object):
         """
         Removes all loaded data.
         """
+        PreparedDataCache.clear()
         cls._facsData.clear()
         
     @classmethod
@@ -201,6 +221,10 @@ class FacsData(object):
         self.filename = filename
         self.displayname = filename
         self.labels = labels
+        self._data = None
+        self._source = None
+        self._stats = {}
+        self._hash = None
         self.data = data
         self.annotations = annotations
         self.analysis = analysis
@@ -213,7 +237,7 @@ class FacsData(object):
         #TODO: move all this to the Clustering class
         # Clustering information 
         self.methodIDs = {}
-        self.clustering = {}
+        self.clustering = ClusteringDict()
         self.clusteringOpts = {}
         self.clusteringSelDims = {}
         # TODO: move this to a dict keyed on ID in the tree class
@@ -222,6 +246,263 @@ class FacsData(object):
         self.selectedClustering = None
         
         
+    def getData(self):
+        """
+        Retrieve the event data, materializing it first if the data set is 
+        backed by a LazyData source.
+        
+        @rtype: numpy.ndarray
+        @return: The m x n array of events.
+        """
+        if self._data is None and self._source is not None:
+            if not self._source.cache:
+                return self._source.materialize()
+            self._data = self._source.materialize()
+        return self._data
+    
+    def setData(self, data):
+        """
+        Set the event data to an array or a LazyData instance.
+        """
+        if isinstance(data, LazyData):
+            self._source = data
+            self._data = None
+        else:
+            self._source = None
+            self._data = data
+        self._stats = {}
+        self._hash = None
+        # the events no longer match the file they were loaded from
+        self.sourceFile = None
+        PreparedDataCache.invalidate(self)
+    
+    data = property(getData, setData, 
+                    doc="""Get/Set the event data of this data set.""")
+    
+    def getStats(self, cols=None):
+        """
+        Summary statistics of the given channels. Each channel's statistics 
+        are computed in a single pass over just its events when first 
+        needed, and kept until the data are replaced.
+        
+        The statistics are a dict of arrays with one value per requested 
+        channel: 'min', 'max', 'mean' and 'var' (ignoring NaN values), and 
+        'quantiles', an array with a row of estimates (from a sample of 
+        the events) for each fraction in STATS_QUANTILES.
+        
+        @type cols: list
+        @param cols: The indices of the channels, or None for all of them.
+        @rtype: dict
+        """
+        cols = range(len(self.labels)) if cols is None else list(cols)
+        missing = sorted(set([c for c in cols if c not in self._stats]))
+        if missing:
+            self._stats.update(self._computeStats(missing))
+        stats = [self._stats[c] for c in cols]
+        result = dict([(k, numpy.array([s[k] for s in stats], dtype=numpy.float64)) 
+                       for k in ['min', 'max', 'mean', 'var']])
+        result['quantiles'] = numpy.array([s['quantiles'] for s in stats], 
+                                          dtype=numpy.float64).reshape((len(cols), len(STATS_QUANTILES))).T
+        return result
+    
+    @property
+    def Stats(self):
+        """The summary statistics of all channels (see L{getStats})."""
+        return self.getStats()
+    
+    def _statsBlocks(self, cols):
+        """Generate the events of the given columns a block of rows at a time."""
+        tot = self.EventCount
+        if self._data is None and self._source is not None:
+            # lazily backed data sets decode just these columns
+            data = self.getColumns(cols)
+            cols = slice(None)
+        else:
+            data = self._data
+        for start in xrange(0, tot, STATS_BLOCK_EVENTS):
+            yield numpy.asarray(data[start:start+STATS_BLOCK_EVENTS][:, cols], dtype=numpy.float64)
+    
+    def _computeStats(self, cols):
+        tot = self.EventCount
+        step = max(1, tot // STATS_SAMPLE_EVENTS)
+        counts = mean = m2 = mins = maxs = None
+        sample = []
+        # sample events at random, as a regular stride could alias with the data
+        rng = numpy.random.RandomState(0)
+        for block in self._statsBlocks(cols):
+            valid = ~numpy.isnan(block)
+            n = valid.sum(0)
+            bmean = numpy.nansum(block, 0) / numpy.maximum(n, 1)
+            bm2 = numpy.nansum((block - bmean)**2, 0)
+            bmin = numpy.where(n > 0, numpy.where(valid, block, numpy.inf).min(0), numpy.nan)
+            bmax = numpy.where(n > 0, numpy.where(valid, block, -numpy.inf).max(0), numpy.nan)
+            # combine the block with the running statistics [Chan et al. 1979]
+            if counts is None:
+                counts, mean, m2, mins, maxs = n, bmean, bm2, bmin, bmax
+            else:
+                total = numpy.maximum(counts + n, 1)
+                delta = bmean - mean
+                mean = mean + delta * n / total
+                m2 = m2 + bm2 + delta**2 * counts * n / total
+                counts = counts + n
+                mins = numpy.fmin(mins, bmin)
+                maxs = numpy.fmax(maxs, bmax)
+            sample.append(block[rng.random_sample(len(block)) * step < 1])
+        
+        stats = {}
+        for i, c in enumerate(cols):
+            if counts is None or counts[i] == 0:
+                stats[c] = {'min': numpy.nan, 'max': numpy.nan, 'mean': numpy.nan, 
+                            'var': numpy.nan, 
+                            'quantiles': [numpy.nan] * len(STATS_QUANTILES)}
+                continue
+            col = numpy.concatenate([s[:,i] for s in sample])
+            col = col[~numpy.isnan(col)]
+            stats[c] = {'min': mins[i], 'max': maxs[i], 'mean': mean[i], 
+                        'var': m2[i] / counts[i], 
+                        'quantiles': numpy.percentile(col, [q*100 for q in STATS_QUANTILES]) 
+                                     if len(col) else [numpy.nan] * len(STATS_QUANTILES)}
+        return stats
+    
+    def getPrepared(self, dims=None, transform=None, **params):
+        """
+        Retrieve the data in the form used for analysis and clustering: the
+        selected columns, transformed, as a contiguous float array of the 
+        type the transform returns (float64 for integer data).
+        
+        Transformed matrices are kept (within a memory budget) by 
+        L{PreparedDataCache}, so repeated analyses of the same columns with 
+        the same transform only prepare the data once, and the columns are
+        only extracted when the matrix is not cached. A transformed array 
+        is shared, and so is read-only. Without a transform, the selected 
+        columns are returned as they are and are not cached.
+        
+        @type dims: list
+        @param dims: The indices of the columns to include, or None for all.
+        @type transform: str
+        @param transform: The ID of a method in L{transforms.methods}, or 
+                          None for the untransformed data.
+        @type params: dict
+        @param params: Options passed on to the transform.
+        @rtype: numpy.ndarray
+        """
+        if dims is not None and list(dims) in [[], range(len(self.labels))]:
+            dims = None
+        if transform is None:
+            return self.getColumns(list(dims)) if dims else self.data
+        
+        key = (tuple(dims) if dims else None, transform, tuple(sorted(params.items())))
+        data = PreparedDataCache.get(self, key)
+        if data is not None:
+            return data
+        
+        data = self.getColumns(list(dims)) if dims else self.data
+        if 'max_clip' not in params and len(data):
+            params['max_clip'] = numpy.nanmax(self.getStats(dims)['max'])
+        data = numpy.asarray(tm.getMethod(transform)(data, **params))
+        dtype = data.dtype if data.dtype.kind == 'f' else numpy.float64
+        # a view, so that freezing it never freezes the data set's own array
+        data = numpy.ascontiguousarray(data, dtype=dtype).view()
+        data.flags.writeable = False
+        
+        PreparedDataCache.put(self, key, data)
+        return data
+    
+    def savedArray(self):
+        """
+        Retrieve the array a project saves for this data set: the events, or
+        the row indices of a derived data set. 
+        
+        The content hash of the array is computed when first needed and kept
+        until the data are replaced, so unchanged data sets are recognized 
+        without reading their events again. Both are returned as functions
+        referring to the data as they are now, so they can be called from 
+        another thread and are unaffected by later changes to the data set.
+        
+        @rtype: tuple
+        @return: Functions returning the content hash and the array.
+        """
+        data = self._data
+        key = self._source if self._source is not None else data
+        if isinstance(key, IndexedData):
+            getArray = lambda: key.index
+        elif data is not None:
+            getArray = lambda: data
+        else:
+            getArray = key.materialize
+        
+        def getHash():
+            # the hash is kept along with the data it was computed for
+            hash = self._hash
+            if hash is None or hash[0] is not key:
+                hash = (key, arrayHash(getArray()))
+                self._hash = hash
+            return hash[1]
+        
+        return getHash, getArray
+    
+    def getDataHash(self):
+        """The content hash of the array saved by projects (see L{savedArray})."""
+        return self.savedArray()[0]()
+    
+    def setDataHash(self, hash):
+        """
+        Set the content hash when it is already known, e.g. from the project
+        file the data were read from.
+        """
+        self._hash = (self._source if self._source is not None else self._data, hash)
+    
+    DataHash = property(getDataHash, setDataHash)
+    
+    @property
+    def Source(self):
+        """The LazyData instance backing the data set, or None."""
+        return self._source
+    
+    def selectEvents(self, rows):
+        """
+        Create the event data for a data set derived from a selection of the
+        events of this one. The selection is held as indices into the 
+        top-level data set, so no events are copied.
+        
+        @type rows: array
+        @param rows: The indices (or a boolean mask) of the selected events.
+        @rtype: data.lazy.IndexedData
+        """
+        if isinstance(self._source, IndexedData):
+            return self._source.select(rows)
+        return IndexedData(self, numpy.arange(self.EventCount, dtype=numpy.int32)[rows])
+    
+    def getColumns(self, dims):
+        """
+        Retrieve only the specified columns of the data. Lazily backed data
+        sets decode just these columns instead of materializing all of them.
+        
+        @type dims: list
+        @param dims: The indices of the desired columns.
+        @rtype: numpy.ndarray
+        @return: An m x len(dims) array.
+        """
+        if self._data is None and self._source is not None:
+            return self._source.columns(dims)
+        return self._data[:, dims]
+    
+    def getRows(self, start, stop):
+        """
+        Retrieve a contiguous range of events without materializing lazily 
+        backed data.
+        """
+        if self._data is None and self._source is not None:
+            return self._source.rows(start, stop)
+        return self._data[start:stop]
+    
+    @property
+    def EventCount(self):
+        """The number of events in the data set."""
+        if self._data is None and self._source is not None:
+            return self._source.shape[0]
+        return len(self._data)
+    
     def collectAllChildren(self, allChildren):
         allChildren.extend(self.children)
         for cID in self.children:
@@ -252,15 +533,18 @@ class FacsData(object):
         
         @type methodID: int
         @param methodID: One of the L{cluster.methods} module-defined ID_* constants for the available methods.
-        @type clusterIDs: list
+        @type clusterIDs: list or array
         @param clusterIDs:  A list where each element indicates the cluster membership of the 
-            corresponding index in the original data.
+            corresponding index in the original data. It is stored as a 
+            L{Clustering}, or as given if it is a L{LazyClustering}.
         @type clusteringOpts: dict
         @param clusteringOpts: A dictionary of algorithm options.
         """
         clustID = cID if (cID is not None) else len(self.clustering)
         
         self.methodIDs[clustID] = methodID
+        if not isinstance(clusterIDs, LazyClustering):
+            clusterIDs = Clustering(clusterIDs)
         self.clustering[clustID] = clusterIDs
         self.clusteringOpts[clustID] = clusteringOpts
         self.infoExpanded[clustID] = False
@@ -313,23 +597,268 @@ class FacsData(object):
         
         
 
-class Clustering(object):
+class PreparedDataCache(object):
+    """
+    PreparedDataCache holds the analysis matrices prepared by 
+    L{FacsData.getPrepared}, keyed on the data set and the preparation 
+    options. The least recently used matrices are evicted when the total 
+    size exceeds the budget.
+    
+    This class provides only class-level members so that it can be used without
+    defining a specific instance or location.
+    """
+    maxBytes = PREPARED_MAX_BYTES
+    _entries = OrderedDict()
+    _bytes = 0
+    
+    @classmethod
+    def configure(cls, maxBytes):
+        """
+        Change the memory budget for prepared matrices.
+        
+        @type maxBytes: int
+        @param maxBytes: The maximum total size of the cached matrices.
+        """
+        cls.maxBytes = maxBytes
+        cls._evict()
+    
+    @classmethod
+    def get(cls, fdata, key):
+        """
+        Retrieve a prepared matrix, or None if it is not cached.
+        """
+        data = cls._entries.pop((fdata, key), None)
+        if data is not None:
+            cls._entries[(fdata, key)] = data
+        return data
+    
+    @classmethod
+    def put(cls, fdata, key, data):
+        """
+        Add a prepared matrix, unless it is larger than the whole budget.
+        """
+        if data.nbytes > cls.maxBytes:
+            return
+        old = cls._entries.pop((fdata, key), None)
+        if old is not None:
+            cls._bytes -= old.nbytes
+        cls._entries[(fdata, key)] = data
+        cls._bytes += data.nbytes
+        cls._evict()
+    
+    @classmethod
+    def invalidate(cls, fdata):
+        """
+        Remove all of the prepared matrices of a data set.
+        """
+        for k in [k for k in cls._entries if k[0] is fdata]:
+            cls._bytes -= cls._entries.pop(k).nbytes
+    
+    @classmethod
+    def clear(cls):
+        cls._entries.clear()
+        cls._bytes = 0
+    
+    @classmethod
+    def _evict(cls):
+        while cls._bytes > cls.maxBytes and cls._entries:
+            cls._bytes -= cls._entries.popitem(last=False)[1].nbytes
+
+
+
+class Clustering(numpy.ndarray):
     """
     This class represents a particular grouping of a data set into clusters
-    of related events (n-dimensional points)
+    of related events (n-dimensional points): a read-only array holding the 
+    cluster ID of each event as the smallest unsigned integer type that fits
+    (uint8 for up to 256 clusters), along with the number of events in each 
+    cluster, which is counted once when first needed. Similarly, the events
+    are sorted by cluster once so that the events of every cluster can be 
+    found in a single pass.
+    
+    The results of arithmetic and comparisons are plain arrays.
     """
-    def __init__(self, ID, labels, methodID, opts, dims):
-        self.ID = ID
-        self.labels = labels
-        self.methodID = methodID
-        self.opts = opts
-        self.selDims = dims
+    def __new__(cls, ids):
+        """
+        @type ids: list or array
+        @param ids: The non-negative integer cluster ID of each event.
+        """
+        if isinstance(ids, Clustering):
+            return ids
+        ids = numpy.asarray(ids)
+        top = int(ids.max()) if ids.size else 0
+        if ids.size and int(ids.min()) < 0:
+            raise ValueError('Cluster IDs must not be negative')
+        for dtype in [numpy.uint8, numpy.uint16, numpy.uint32]:
+            if top <= numpy.iinfo(dtype).max:
+                break
+        obj = ids.astype(dtype).view(cls)
+        obj.flags.writeable = False
+        return obj
+    
+    def __array_finalize__(self, obj):
+        self._counts = None
+        self._order = None
+        self._hash = None
+    
+    def __array_wrap__(self, out, context=None):
+        return out.view(numpy.ndarray) if out.ndim else out[()]
+    
+    @property
+    def Counts(self):
+        """
+        The number of events in each cluster, indexed by cluster ID (IDs 
+        without events have a count of 0).
+        """
+        if getattr(self, '_counts', None) is None:
+            self._counts = numpy.bincount(self.view(numpy.ndarray))
+        return self._counts
+    
+    @property
+    def Hash(self):
+        """The content hash of the cluster IDs (see L{arrayHash})."""
+        if getattr(self, '_hash', None) is None:
+            self._hash = arrayHash(self.view(numpy.ndarray))
+        return self._hash
+    
+    @property
+    def IDs(self):
+        """The sorted IDs of the clusters containing events."""
+        return numpy.flatnonzero(self.Counts)
+    
+    @property
+    def Order(self):
+        """
+        The indices of the events stably sorted by cluster ID, so that the 
+        events of each cluster are contiguous and in their original order.
+        """
+        if getattr(self, '_order', None) is None:
+            self._order = numpy.argsort(self.view(numpy.ndarray), 
+                                        kind='mergesort').astype(numpy.int32)
+        return self._order
+    
+    @property
+    def Bounds(self):
+        """The positions in Order at which each cluster after the first starts."""
+        return numpy.cumsum(self.Counts[self.IDs])[:-1]
+    
+    def groups(self):
+        """
+        Retrieve the indices of the events in each cluster.
+        
+        @rtype: list
+        @return: An array of event indices for each cluster containing 
+                 events, in order of cluster ID. Each is a view of Order.
+        """
+        if not len(self):
+            return []
+        return numpy.split(self.Order, self.Bounds)
+
+
+
+class LazyClustering(object):
+    """
+    The cluster IDs of a clustering as they were saved, such as an array 
+    memory-mapped from a project, which are only converted to a 
+    L{Clustering} when the clustering is first used (see L{ClusteringDict}).
+    """
+    def __init__(self, ids, hash=None):
+        """
+        @type ids: array
+        @param ids: The cluster IDs as saved from a L{Clustering}.
+        @type hash: str
+        @param hash: The content hash of the IDs, if known.
+        """
+        self.ids = ids
+        self._hash = hash
+    
+    def __array__(self, dtype=None):
+        return numpy.asarray(self.ids, dtype)
+    
+    @property
+    def Hash(self):
+        """The content hash of the cluster IDs (see L{arrayHash})."""
+        if self._hash is None:
+            self._hash = arrayHash(self.ids)
+        return self._hash
+    
+    def materialize(self):
+        """
+        @rtype: Clustering
+        @return: The clustering, with the hash already known.
+        """
+        clustering = Clustering(self.ids)
+        if self._hash is not None:
+            clustering._hash = self._hash
+        return clustering
+
+
+
+class ClusteringDict(dict):
+    """
+    The clusterings of a data set by ID. A L{LazyClustering} is replaced by
+    its L{Clustering} when it is first retrieved.
+    """
+    def __getitem__(self, cID):
+        clustering = dict.__getitem__(self, cID)
+        if isinstance(clustering, LazyClustering):
+            clustering = clustering.materialize()
+            dict.__setitem__(self, cID, clustering)
+        return clustering
+    
+    def get(self, cID, default=None):
+        return self[cID] if cID in self else default
+    
+    def itervalues(self):
+        for cID in self:
+            yield self[cID]
+    
+    def iteritems(self):
+        for cID in self:
+            yield cID, self[cID]
+    
+    def values(self):
+        return list(self.itervalues())
+    
+    def items(self):
+        return list(self.iteritems())
+    
+    def peek(self, cID):
+        """
+        Retrieve a clustering without converting it if it has not been used,
+        e.g. to save it unchanged.
+        
+        @rtype: Clustering or LazyClustering
+        """
+        return dict.__getitem__(self, cID)
         
         
 
 
         
         
+def arrayHash(data):
+    """
+    Compute a hash identifying the contents of an array: its type, shape 
+    and values. The array is hashed in blocks of rows, so non-contiguous 
+    arrays are not copied in full.
+    
+    @type data: numpy.ndarray
+    @rtype: str
+    @return: The hex digest of the hash.
+    """
+    data = numpy.asarray(data)
+    h = hashlib.sha1('%s%r' % (data.dtype.str, data.shape))
+    if data.ndim == 0:
+        h.update(data.tostring())
+        return h.hexdigest()
+    step = max(1, HASH_BLOCK_ITEMS // max(1, data[:1].size))
+    for i in xrange(0, len(data), step):
+        h.update(numpy.ascontiguousarray(data[i:i+step]).data)
+    return h.hexdigest()
+
+
+
 class FigureStore(object):
     _figures = {}
     _selectedIndex = None
@@ -502,6 +502,28 @@ class Subplot(object):
                     doc="""Get the FacsData instance or Set the DataStore ID 
                            of the dataset visualized by this subplot.""")
     
+    def getColumns(self, dims):
+        """
+        Retrieve only the specified columns of the data backing this subplot.
+        
+        @type dims: list
+        @param dims: The indices of the desired columns.
+        @rtype: numpy array
+        @return: An array containing just the requested columns.
+        """
+        return DataStore.getData()[self.dataIndex].getColumns(dims)
+    
+    def getStats(self, cols=None):
+        """
+        The per-channel summary statistics of the data set backing this 
+        subplot (see L{data.store.FacsData.getStats}).
+        """
+        return DataStore.getData()[self.dataIndex].getStats(cols)
+    
+    @property
+    def Stats(self):
+        return self.getStats()
+    
 
     
     def getClustering(self):
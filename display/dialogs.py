@@ -274,4 +274,136 @@ class DataInfoDialog(wx.Dialog):
     
       
         
-        
\ No newline at end of file
+
+
+def _callIfAlive(window, method, *args):
+    """Call a method of a window, unless the window was destroyed meanwhile."""
+    if window:
+        getattr(window, method)(*args)
+
+
+class CatalogSearchDialog(wx.Dialog):
+    """
+    This dialog searches the catalog of a directory tree of FCS files by 
+    TEXT keyword and channel name, and allows the user to choose which of
+    the matching files to load. Only the file headers are read, so even
+    large directories can be searched quickly.
+    
+    The catalog is brought up to date on a worker thread, with the number of
+    files examined shown as it goes.
+    """
+    def __init__(self, parent, directory=''):
+        wx.Dialog.__init__(self, parent, wx.ID_ANY, 'Find FCS Files', 
+                           style=wx.RESIZE_BORDER|wx.DEFAULT_DIALOG_STYLE, size=(500, 450))
+        self.CenterOnParent()
+        self.catalog = None
+        self.results = []
+        self.worker = None
+        
+        # create form controls
+        self.dirPicker = wx.DirPickerCtrl(self, wx.ID_ANY, directory)
+        self.txtKeyword = wx.TextCtrl(self, wx.ID_ANY, '')
+        self.txtValue = wx.TextCtrl(self, wx.ID_ANY, '')
+        self.txtChannel = wx.TextCtrl(self, wx.ID_ANY, '')
+        self.cmdSearch = wx.Button(self, wx.ID_ANY, 'Search')
+        self.cmdSearch.Bind(wx.EVT_BUTTON, self.cmdSearch_Click)
+        self.lstResults = wx.CheckListBox(self, wx.ID_ANY)
+        self.lblStatus = wx.StaticText(self, wx.ID_ANY, '')
+        
+        # create a table of label-input controls
+        self.formSizer = wx.FlexGridSizer(4, 2, vgap=5, hgap=10) #rows,cols,vgap,hgap
+        self.formSizer.AddGrowableCol(1)
+        self.formSizer.Add(wx.StaticText(self, -1, 'Directory:'), 0, wx.ALIGN_RIGHT)
+        self.formSizer.Add(self.dirPicker, 1, wx.EXPAND)
+        self.formSizer.Add(wx.StaticText(self, -1, 'Keyword:'), 0, wx.ALIGN_RIGHT)
+        self.formSizer.Add(self.txtKeyword, 1, wx.EXPAND)
+        self.formSizer.Add(wx.StaticText(self, -1, 'Value contains:'), 0, wx.ALIGN_RIGHT)
+        self.formSizer.Add(self.txtValue, 1, wx.EXPAND)
+        self.formSizer.Add(wx.StaticText(self, -1, 'Channel contains:'), 0, wx.ALIGN_RIGHT)
+        self.formSizer.Add(self.txtChannel, 1, wx.EXPAND)
+        
+        # main sizer
+        self.sizer = wx.BoxSizer(wx.VERTICAL)
+        self.sizer.Add(self.formSizer, 0, wx.EXPAND | wx.ALL, 10)
+        self.sizer.Add(self.cmdSearch, 0, wx.ALIGN_RIGHT | wx.RIGHT, 10)
+        self.sizer.AddSpacer(5)
+        self.sizer.Add(self.lstResults, 1, wx.EXPAND | wx.LEFT | wx.RIGHT, 10)
+        self.sizer.Add(self.lblStatus, 0, wx.EXPAND | wx.ALL, 10)
+        self.sizer.Add(self.CreateButtonSizer(wx.OK | wx.CANCEL), 0, wx.EXPAND)
+        self.sizer.AddSpacer(5)
+        self.SetSizer(self.sizer)
+        
+        
+    def cmdSearch_Click(self, event):
+        import os.path
+        import threading
+        from data.catalog import FCSCatalog
+        
+        directory = self.Directory
+        if not os.path.isdir(directory):
+            wx.MessageBox("Please choose a directory to search.", "Invalid Directory", 
+                          wx.OK | wx.ICON_ERROR)
+            return
+        
+        # (re)open the catalog and bring it up to date with the directory
+        if self.catalog is None or self.catalog.root != os.path.abspath(directory):
+            if self.catalog is not None:
+                self.catalog.close()
+            self.catalog = FCSCatalog(directory)
+        
+        self.cmdSearch.Disable()
+        self.lblStatus.Label = 'Updating catalog...'
+        self.worker = threading.Thread(target=self.refreshCatalog)
+        self.worker.start()
+    
+    
+    def refreshCatalog(self):
+        """
+        Update the catalog (on the worker thread), reporting progress and 
+        then the search results to the GUI thread.
+        """
+        def progress(count, path):
+            if count % 50 == 0:
+                wx.CallAfter(_callIfAlive, self, 'showProgress', count)
+        try:
+            self.catalog.refresh(progress)
+        finally:
+            wx.CallAfter(_callIfAlive, self, 'showResults')
+    
+    
+    def showProgress(self, count):
+        self.lblStatus.Label = 'Updating catalog: %i files examined...' % count
+    
+    
+    def showResults(self):
+        import os.path
+        
+        self.worker = None
+        self.cmdSearch.Enable()
+        self.results = self.catalog.search(self.txtKeyword.Value.strip(), 
+                                           self.txtValue.Value.strip(), 
+                                           self.txtChannel.Value.strip())
+        root = self.catalog.root
+        self.lstResults.Set(['%s  (%i events)' % (os.path.relpath(r['path'], root), r['events']) 
+                             for r in self.results])
+        self.lblStatus.Label = '%i matching files' % len(self.results)
+        if not self.catalog.Persistent:
+            self.lblStatus.Label += ' (the catalog can not be saved in this directory)'
+    
+    
+    def Destroy(self):
+        if self.worker is not None:
+            self.catalog.cancel()
+            self.worker.join()
+        if self.catalog is not None:
+            self.catalog.close()
+        return wx.Dialog.Destroy(self)
+    
+    @property
+    def Directory(self):
+        return self.dirPicker.Path
+    
+    @property
+    def SelectedPaths(self):
+        return [self.results[i]['path'] for i in range(len(self.results)) 
+                if self.lstResults.IsChecked(i)]
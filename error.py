@@ -121,7 +121,15 @@ def sendErrorReport(err, userMsg):
 
         
 def warnUser(message, title='Warning'):
-    wx.MessageBox(message, title, wx.OK | wx.ICON_WARNING)
+    """
+    Show a warning message. Warnings raised on a background thread (e.g. 
+    while a file is decoded by L{data.io.FileLoader}) are shown by the GUI 
+    thread, as wx may only be used from there.
+    """
+    if wx.Thread_IsMain():
+        wx.MessageBox(message, title, wx.OK | wx.ICON_WARNING)
+    else:
+        wx.CallAfter(wx.MessageBox, message, title, wx.OK | wx.ICON_WARNING)
         
         
         
@@ -13,8 +13,10 @@ import plot.methods as pMthds
 
 import display.dialogs as displayDialogs
 import display.view as displayView
+from data.lazy import LazyData
 from data.store import DataStore, FacsData, FigureStore, Figure
 from data import io
+from data.IO.fcs import read_spill
 import data.fast_kde as dfk
 import error
 import plugin
@@ -28,12 +30,18 @@ from wx.lib.wordwrap import wordwrap
 # System imports
 import math
 from operator import itemgetter
+import os
 import sys
 import traceback 
 
 # CONSTANTS
 # File Menu
 ID_OPEN       = wx.NewId()
+ID_OPEN_MMAP  = wx.NewId()
+ID_OPEN_FIND  = wx.NewId()
+ID_OPEN_COMP  = wx.NewId()
+ID_OPEN_SPILL = wx.NewId()
+ID_OPEN_SPILL_CLEAR = wx.NewId()
 ID_LOAD_STATE = wx.NewId()
 ID_SAVE_STATE = wx.NewId()
 
@@ -50,6 +58,9 @@ ID_DATA_RECOLOR = wx.NewId()
 # Help Menu
 ID_HELP_UPDATE = wx.NewId()
 
+# number of events shown when previewing a data file
+PREVIEW_EVENTS = 10
+
 # Controls
 ID_CBX = wx.NewId()
 ID_LINKED = wx.NewId()
@@ -130,9 +141,28 @@ class MainWindow(wx.Frame):
         # Open file
         fileMenu.Append(ID_OPEN, "Open File(s)...\tCtrl+O"," Open a file to edit")
         self.Bind(wx.EVT_MENU, self.OnOpen, id=ID_OPEN)
+        fileMenu.Append(ID_OPEN_FIND, "Find FCS Files...", 
+                        " Search a directory tree of FCS files by keyword or channel")
+        self.Bind(wx.EVT_MENU, self.OnFindFiles, id=ID_OPEN_FIND)
+        fileMenu.AppendCheckItem(ID_OPEN_MMAP, "Memory-map FCS Files", 
+                                 " Leave FCS event data on disk and decode it only when it is used")
+        fileMenu.AppendCheckItem(ID_OPEN_COMP, "Compensate FCS Files", 
+                                 " Apply the spillover matrix stored in FCS files when loading them")
+        # a spillover matrix loaded by the user replaces those of the files
+        self.spillover = None
+        fileMenu.Append(ID_OPEN_SPILL, "Load Spillover Matrix...", 
+                        " Compensate FCS files with a spillover matrix read from a file")
+        self.Bind(wx.EVT_MENU, self.OnLoadSpillover, id=ID_OPEN_SPILL)
+        fileMenu.Append(ID_OPEN_SPILL_CLEAR, "Use File Spillover Matrices", 
+                        " Compensate FCS files with the spillover matrix they store")
+        self.Bind(wx.EVT_MENU, self.OnClearSpillover, id=ID_OPEN_SPILL_CLEAR)
         # Save/Load system state
         fileMenu.Append(ID_SAVE_STATE, "Save project...\tCtrl+S","Save the state of the current analysis project.")
         self.Bind(wx.EVT_MENU, self.OnSaveState, id=ID_SAVE_STATE)
+        # projects are saved in the background, with progress polled by a timer
+        self.saver = None
+        self.saveTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnSaveProgress, self.saveTimer)
         fileMenu.Append(ID_LOAD_STATE, "Load project...\tCtrl+L","Load a saved analysis project.")
         self.Bind(wx.EVT_MENU, self.OnLoadState, id=ID_LOAD_STATE)
         # Export submenu
@@ -277,6 +307,8 @@ class MainWindow(wx.Frame):
         self.facsPlotPanel.setCurrentSubplotLinked(self.chkLinked.Value)
         
     def OnExit(self, event):
+        # a project still being saved is finished before the program exits
+        self.saveTimer.Stop()
         self.treeCtrlPanel.Destroy()
         self.Destroy()
 
@@ -296,74 +328,179 @@ class MainWindow(wx.Frame):
         """
         # retrieve the I/O methods for inputting files
         inputMethods = [m[2]() for m in io.AvailableMethods().values()]
-        formats = '|'.join([m.FileType for m in inputMethods if io.FILE_INPUT in m.register()])
+        # methods registered for several extensions are listed once
+        formats = []
+        for m in inputMethods:
+            if io.FILE_INPUT in m.register() and m.FileType not in formats:
+                formats.append(m.FileType)
+        formats = '|'.join(formats)
+        
+        dlg = wx.FileDialog(self, "Choose a file", self.dirname, "", formats, 
+                            wx.FD_OPEN|wx.FD_MULTIPLE|wx.FD_CHANGE_DIR)
+        if dlg.ShowModal() == wx.ID_OK:
+            self.loadFiles(dlg.Paths)
+        dlg.Destroy()
+    
+    def OnFindFiles(self, event):
+        """
+        Search a cataloged directory of FCS files and load the chosen ones.
+        """
+        dlg = displayDialogs.CatalogSearchDialog(self, self.dirname)
+        if dlg.ShowModal() == wx.ID_OK and dlg.SelectedPaths:
+            self.dirname = dlg.Directory
+            self.loadFiles(dlg.SelectedPaths)
+        dlg.Destroy()
+    
+    def OnLoadSpillover(self, event):
+        """
+        Read a spillover matrix to compensate FCS files with in place of the 
+        matrices they store (see L{data.IO.fcs.read_spill}), and turn on 
+        compensation.
+        """
+        dlg = wx.FileDialog(self, "Choose a spillover matrix file", self.dirname, "", 
+                            "Spillover matrix (*.csv;*.txt)|*.csv;*.txt|All files (*.*)|*.*", 
+                            wx.FD_OPEN)
+        if dlg.ShowModal() == wx.ID_OK:
+            try:
+                self.spillover = read_spill(dlg.Path)
+            except (IOError, ValueError), err:
+                wx.MessageBox('The spillover matrix could not be read from %s:\n%s' % (dlg.Path, err), 
+                              'Spillover Matrix Error', wx.OK | wx.ICON_ERROR)
+            else:
+                self.GetMenuBar().Check(ID_OPEN_COMP, True)
+                self.statusbar.SetStatusText('Compensating FCS files with the %ix%i spillover matrix from %s' % 
+                                             (len(self.spillover[1]), len(self.spillover[1]), dlg.Filename), 0)
+        dlg.Destroy()
+    
+    def OnClearSpillover(self, event):
+        """
+        Go back to compensating FCS files with the matrices they store.
+        """
+        self.spillover = None
+        self.statusbar.SetStatusText('Compensating FCS files with their own spillover matrices', 0)
+    
+    def loadFiles(self, paths):
+        """
+        Load each of the specified data files into the DataStore, allowing
+        the user to preview, rearrange and select the columns of each.
+        
+        :@type paths: list
+        :@param paths: The full paths of the files to load.
+        """
         allLabels = []
         allColArr = []
         allDims   = []
         fColsMoved = False
         numLoaded = 0
+        loadOpts = {}
+        if self.GetMenuBar().IsChecked(ID_OPEN_MMAP):
+            loadOpts['mmap'] = True
+        loadOpts['auto_comp'] = self.GetMenuBar().IsChecked(ID_OPEN_COMP)
+        if loadOpts['auto_comp'] and self.spillover is not None:
+            loadOpts['spill'], loadOpts['sidx'] = self.spillover
         
         # keep track of the common number of dimensions for datasets
         numDims = DataStore.getCurrentDataSet()
         if numDims is not None:
             numDims = len(numDims.labels)
         
-        dlg = wx.FileDialog(self, "Choose a file", self.dirname, "", formats, 
-                            wx.FD_OPEN|wx.FD_MULTIPLE|wx.FD_CHANGE_DIR)
-        if dlg.ShowModal() == wx.ID_OK:
-            #TODO: move to data.io module?
-            # process each file selected
-            for n, path in enumerate(dlg.Paths):
-                self.statusbar.SetStatusText('loading: ' + path, 0)
+        # decode the files in the background and process them in the order 
+        # they were selected
+        loader = io.FileLoader(paths, window=self, **loadOpts)
+        loader.start()
+        
+        # Read just the start of the first file so its preview can be shown
+        # while the full data sets are decoded
+        arrangements = {}
+        if not io.isInteractive(paths[0]):
+            try:
+                (labels, sample, _) = io.loadDataFile(paths[0], preview=PREVIEW_EVENTS, **loadOpts)
+            except Exception:
+                # any errors will be reported when the full file is loaded
+                pass
+            else:
+                if numDims is None or len(labels) == numDims:
+                    arrangements[0] = self.arrangeColumns(sample, labels)
+        
+        progDlg = wx.ProgressDialog('Loading Files', 'Loading %i files' % len(paths), 
+                                    len(paths), self, wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME | 
+                                                      wx.PD_REMAINING_TIME | wx.PD_AUTO_HIDE)
+        def poll(n, path):
+            msg = 'loading (%i of %i): %s' % (n+1, len(paths), os.path.basename(path))
+            self.statusbar.SetStatusText(msg, 0)
+            return progDlg.Update(n, msg)[0]
+        
+        try:
+            for i, (n, path, result) in enumerate(loader.results(poll)):
+                if not poll(n, path):
+                    loader.cancel()
+                    break
+                if isinstance(result, Exception):
+                    wx.MessageBox("Error loading file: %s\n\n%s\n\nThis file will not be loaded." % (os.path.basename(path), result),
+                                  "File Error", wx.OK | wx.ICON_ERROR)
+                    continue
                 try:
-                    (labels, data, annotations) = io.loadDataFile(path, window=self)
+                    (labels, data, annotations) = result
                 except TypeError:
                     # if there was an error loading the file, 
                     # loadDataFile should return None, so skip this file
                     continue
-                
+            
                 # make sure the new file matches dimensions of loaded files
                 if numDims is None:
                     numDims = len(labels)
                 elif len(labels) != numDims:
-                    wx.MessageBox("Error loading file: %s\n\nThe number of channels does not match those in currently loaded datasets. \n\nThis file will not be loaded." % dlg.Filenames[n],
+                    wx.MessageBox("Error loading file: %s\n\nThe number of channels does not match those in currently loaded datasets. \n\nThis file will not be loaded." % os.path.basename(path),
                                   "File Error", wx.OK | wx.ICON_ERROR)
                     continue
-                    
                 
-                # Give the user a brief preview of the data (10 rows) and allow
-                # column rearrangement and renaming
+            
+                # Give the user a brief preview of the data and allow column 
+                # rearrangement and renaming, unless that was done from a 
+                # partial read already
+                columns = None
                 if (not allLabels):
-                    dgridDlg = displayDialogs.SampleDataDisplayDialog(self, data[0:10,:], labels)
-                    if (dgridDlg.ShowModal() == wx.ID_OK):
-                        ca = dgridDlg.ColumnArrangement
-                        lbls = dgridDlg.ColumnLabels
-                        # Reassign the column labels
-                        labels = [lbls[i] for i in ca]
-                        
-                        if dgridDlg.ApplyToAll:
-                            allLabels = list(labels)
-                            allColArr = list(ca)
-                        
-                        # Rearrange the data columns
-                        if (dgridDlg.ColumnsMoved):
-                            fColsMoved = True
-                            data = dh.reorderColumns(data, ca)
+                    if i in arrangements:
+                        arrangement = arrangements.pop(i)
                     else:
-                        dgridDlg.Destroy()
+                        sample = data.rows(0, PREVIEW_EVENTS) if isinstance(data, LazyData) \
+                                 else data[0:PREVIEW_EVENTS,:]
+                        arrangement = self.arrangeColumns(sample, labels)
+                    if arrangement is None:
                         continue
-                    dgridDlg.Destroy()
+                
+                    ca, labels, colsMoved, applyToAll = arrangement
+                    if applyToAll:
+                        allLabels = list(labels)
+                        allColArr = list(ca)
+                
+                    # Rearrange the data columns
+                    if (colsMoved):
+                        fColsMoved = True
+                        columns = ca
+                        data = dh.reorderColumns(data, ca)
                 else:
                     labels = list(allLabels)
                     if fColsMoved:
+                        columns = allColArr
                         data = dh.reorderColumns(data, allColArr)
-                    
-                # update the DataStore
-                DataStore.add(FacsData(dlg.Filenames[n], labels, data, annotations=annotations))
+                
+                # update the DataStore, numbering the data sets of files with several
+                name = os.path.basename(path)
+                if 'dataset' in annotations:
+                    name += ' (%i)' % (annotations['dataset'][0]+1)
+                fdata = FacsData(name, labels, data, annotations=annotations)
+                # remember the file, so projects can reload the events from it
+                if not io.isInteractive(path):
+                    opts = dict(loadOpts)
+                    if 'dataset' in annotations:
+                        opts['dataset'] = annotations['dataset'][0]
+                    fdata.sourceFile = io.sourceReference(path, columns, **opts)
+                DataStore.add(fdata)
                 numLoaded += 1
-                if n == 0:
+                if i == 0:
                     self.updateAxesList(labels)
-                    
+                
                 if (not allDims):
                     # Allow the user to choose columns for use in analysis
                     dimDlg = displayDialogs.DimensionExclusionDialog(self, labels)
@@ -378,22 +515,51 @@ class MainWindow(wx.Frame):
 
                 # update the panel
                 self.facsPlotPanel.updateAxes([0,1])
-                if (len(self.facsPlotPanel.subplots) == 0 or len(dlg.Paths) > 1):
+                if (len(self.facsPlotPanel.subplots) == 0 or len(paths) > 1 or
+                    'dataset' in annotations):
                     self.facsPlotPanel.addSubplot(DataStore.getCurrentIndex())
-        
-            # Create an n/2 x 2 grid for the n selected data files
-            if (numLoaded > 1):
-                self.facsPlotPanel.updateSubplotGrid(int(math.ceil(numLoaded/2.0)), 2)
+        finally:
+            progDlg.Destroy()
+    
+        # Create an n/2 x 2 grid for the n selected data files
+        if (numLoaded > 1):
+            self.facsPlotPanel.updateSubplotGrid(int(math.ceil(numLoaded/2.0)), 2)
+        if loader.Cancelled:
+            self.statusbar.SetStatusText('Loading cancelled: %i data sets loaded.' % numLoaded)
+        else:
             self.statusbar.SetStatusText('All data files loaded.')
-            
-            if FigureStore.isEmpty():
-                fig = Figure('Default', self.facsPlotPanel.subplots, 1,
-                             self.facsPlotPanel.Grid, 
-                             self.facsPlotPanel.SelectedAxes)
-                FigureStore.add(fig)
-            self.treeCtrlPanel.updateTree()
-            
-        dlg.Destroy()
+        
+        if FigureStore.isEmpty():
+            fig = Figure('Default', self.facsPlotPanel.subplots, 1,
+                         self.facsPlotPanel.Grid, 
+                         self.facsPlotPanel.SelectedAxes)
+            FigureStore.add(fig)
+        self.treeCtrlPanel.updateTree()
+        
+    def arrangeColumns(self, sample, labels):
+        """
+        Give the user a brief preview of a data set and allow column 
+        rearrangement and renaming.
+        
+        :@type sample: numpy.ndarray
+        :@param sample: The first few events of the data set.
+        :@type labels: list
+        :@param labels: The column labels of the data set.
+        :@rtype: tuple
+        :@return: The column arrangement, the rearranged labels, whether the 
+                  columns were moved, and whether the choices should be 
+                  applied to all files; or None if the user cancelled.
+        """
+        dgridDlg = displayDialogs.SampleDataDisplayDialog(self, sample, labels)
+        try:
+            if (dgridDlg.ShowModal() != wx.ID_OK):
+                return None
+            ca = dgridDlg.ColumnArrangement
+            lbls = dgridDlg.ColumnLabels
+            # Reassign the column labels
+            return (ca, [lbls[i] for i in ca], dgridDlg.ColumnsMoved, dgridDlg.ApplyToAll)
+        finally:
+            dgridDlg.Destroy()
         
     def OnExport(self, event):
         if DataStore.getCurrentIndex() is None:
@@ -411,7 +577,10 @@ class MainWindow(wx.Frame):
         dlg.Destroy()
     
     def OnSaveState(self, event):
-        from data.io import saveState
+        if self.saver is not None:
+            wx.MessageBox("The project is still being saved. Please wait for the save to finish.",
+                          "Save in Progress", wx.OK | wx.ICON_INFORMATION)
+            return
         
         dlg = wx.FileDialog(self, "Save project to file", "", "", "*.find", wx.FD_SAVE|wx.FD_OVERWRITE_PROMPT)
         if dlg.ShowModal() == wx.ID_OK and dlg.Filename:
@@ -420,10 +589,31 @@ class MainWindow(wx.Frame):
                 dlg.Path = dlg.Path + '.find'
             
             dv.saveToFigure(self.facsPlotPanel, FigureStore.getSelectedFigure())
-            saveState(dlg.Directory, dlg.Filename)
-            self.statusbar.SetStatusText("Project saved to %s" % dlg.Path, 0)
+            # the state is copied now, and written in the background
+            self.saver = io.ProjectSaver(dlg.Directory, dlg.Filename)
+            self.saver.start()
+            self.saveTimer.Start(200)
+            self.statusbar.SetStatusText("Saving project to %s" % dlg.Path, 0)
             
         dlg.Destroy()
+    
+    def OnSaveProgress(self, event):
+        """
+        Report the progress of a background project save in the status bar.
+        """
+        if not self.saver.Done:
+            stage, fraction = self.saver.Progress
+            self.statusbar.SetStatusText("Saving project (%s): %i%%" % (stage, 100*fraction), 0)
+            return
+        
+        self.saveTimer.Stop()
+        saver, self.saver = self.saver, None
+        if saver.Error is not None:
+            self.statusbar.SetStatusText("Project not saved", 0)
+            wx.MessageBox("The project could not be saved to %s:\n\n%s" % (saver.path, saver.Error),
+                          "Save Error", wx.OK | wx.ICON_ERROR)
+        else:
+            self.statusbar.SetStatusText("Project saved to %s" % saver.path, 0)
             
 
     def OnLoadState(self, event):
@@ -441,7 +631,8 @@ class MainWindow(wx.Frame):
         dlg = wx.FileDialog(self, "Select saved project", self.dirname, "", formats, wx.FD_OPEN)
         if dlg.ShowModal() == wx.ID_OK:
             try:
-                loadState(dlg.Directory, dlg.Filename)
+                loadState(dlg.Directory, dlg.Filename, 
+                          status=lambda msg: self.statusbar.SetStatusText(msg, 0))
             except error.ProjectLoadingError:
                 return
             # Load all Figures with Subplot instances from the stored dicts
@@ -485,10 +676,11 @@ class MainWindow(wx.Frame):
                 strID = aMthds.strID(event.GetId())
                 self.statusbar.SetStatusText('Running %s...' % aMthds.AvailableMethods()[strID][2], 0)
                 fcs = DataStore.getCurrentDataSet()
-                data = fcs.data
                 # Remove columns from analysis as specified by the user
                 if len(fcs.selDims) > 0:
-                    data = dh.filterData(data, fcs.selDims)
+                    data = fcs.getColumns(fcs.selDims)
+                else:
+                    data = fcs.data
                 args = {'parentWindow': self}
                 _, msg = aMthds.getMethod(strID)(data, **args)
                 self.statusbar.SetStatusText(msg, 0)
@@ -511,11 +703,16 @@ class MainWindow(wx.Frame):
             if (DataStore.getCurrentDataSet() is not None):
                 self.statusbar.SetStatusText('Running %s clustering...' % cMthds.methods[event.GetId()][1], 0)
                 fcs = DataStore.getCurrentDataSet()
-                data = fcs.data
-                # Remove columns from analysis as specified by the user
-                if len(fcs.selDims) > 0:
-                    data = dh.filterData(data, fcs.selDims)
-                clusterIDs, msg = cMthds.cluster(event.GetId(), data, **dlg.getMethodArgs())
+                # Remove columns from analysis as specified by the user; any 
+                # transformed data are cached on the data set, and methods 
+                # that read only those are not given the columns themselves
+                dims = fcs.selDims if len(fcs.selDims) > 0 else None
+                data = None
+                if not cMthds.usesPrepare(event.GetId()):
+                    data = fcs.getPrepared(dims)
+                prepare = lambda transform, **params: fcs.getPrepared(dims, transform, **params)
+                clusterIDs, msg = cMthds.cluster(event.GetId(), data, prepare=prepare, 
+                                                 **dlg.getMethodArgs())
                 DataStore.addClustering(event.GetId(), clusterIDs, dlg.getMethodArgs())
                 clusteringIndex = DataStore.getCurrentDataSet().clustering.keys()[-1]
                 self.statusbar.SetStatusText(msg, 0)
@@ -622,7 +819,7 @@ class MainWindow(wx.Frame):
         """
         fcData = DataStore.getCurrentDataSet()
         if fcData is not None:
-            dgridDlg = displayDialogs.SampleDataDisplayDialog(self, fcData.data[0:10,:], 
+            dgridDlg = displayDialogs.SampleDataDisplayDialog(self, fcData.getRows(0, 10), 
                                                               fcData.labels, 'Edit Channel Labels',
                                                               False, False)
             if (dgridDlg.ShowModal() == wx.ID_OK):
@@ -4,7 +4,6 @@ Created on Feb 12, 2010
 @author: shareef
 '''
 # PLOTTING METHOD
-from cluster.util import separate
 import methods
 
 import numpy.numarray as na
@@ -21,25 +20,26 @@ def barplot(subplot, figure, dims=None):
     Some techniques borrowed from:
     http://www.scipy.org/Cookbook/Matplotlib/BarCharts
     """
-    clusters = separate(subplot.Data, subplot.Clustering)
+    clustering = subplot.Clustering
+    counts = clustering.Counts[clustering.IDs]
     
     # set default plot options
     opts = subplot.opts
     if len(opts) == 0:
-        opts['labelAngle'] = 0 if len(clusters) < 5 else -20
+        opts['labelAngle'] = 0 if len(counts) < 5 else -20
         opts['view'] = 'percent'
     # correcting for previous version
     if 'view' not in opts:
         opts['view'] = 'percent'
     
-    dataSize = len(subplot.Data)
+    dataSize = len(clustering)
     if opts['view'] == 'toplevel':
-        dataSize = len(DataStore.getToplevelParent(subplot.dataIndex).data)
+        dataSize = DataStore.getToplevelParent(subplot.dataIndex).EventCount
     
     if opts['view'] in ['percent', 'toplevel']:
-        displayNums = [float(len(cluster))/dataSize*100 for cluster in clusters]
+        displayNums = [float(count)/dataSize*100 for count in counts]
     else:
-        displayNums = [len(cluster) for cluster in clusters]
+        displayNums = list(counts)
         
     numBars = len(displayNums)
     width = 0.5
@@ -6,6 +6,7 @@ Created on Feb 11, 2010
 import display.formatters as f
 from display.text import StyledStaticText
 import display.validators as v
+import transforms.methods as tm
 
 import wx
 
@@ -222,7 +223,7 @@ class TransformOptionsPanel(OptionsDialogPanel):
         wx.Panel.__init__(self, parent)
 
         # Init controls
-        self.transforms = ['linear','log'] 
+        self.transforms = tm.getScaleTransforms()
         self.cbxX_Transform = wx.ComboBox(self, choices=self.transforms, 
                                           style=wx.CB_READONLY)
         self.cbxY_Transform = wx.ComboBox(self, choices=self.transforms, 
@@ -295,7 +296,7 @@ class SingleTransformOptionsPanel(OptionsDialogPanel):
         wx.Panel.__init__(self, parent)
         
         # Init controls
-        self.transforms = ['linear','log'] 
+        self.transforms = tm.getScaleTransforms()
         self.cbxTransform = wx.ComboBox(self, choices=self.transforms, 
                                           style=wx.CB_READONLY)
         self.chkTransformAuto = wx.CheckBox(self, label="Auto")
@@ -14,7 +14,7 @@ def boxplot(subplot, figure, dims=None):
         opts['labelAngle'] = -20
         
     
-    ymax = np.max(np.maximum.reduce(subplot.Data))
+    ymax = np.nanmax(subplot.Stats['max'])
     ylim = (1, ymax*10)
     # create the subplot and set its attributes
     subplot.axes = figure.add_subplot(subplot.mnp, 
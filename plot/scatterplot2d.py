@@ -35,10 +35,14 @@ def scatterplot2D(subplot, figure, dims):
                 opts[tf[i]] = 'linear'
             
     
+    # only the two displayed columns are needed
+    cols = subplot.getColumns(list(dims))
+    
+    xmax, ymax = subplot.getStats(list(dims))['max']
     if opts['xRangeAuto']:
-        opts['xRange'] = (1, np.max(subplot.Data[:,dims[0]])*1.5)
+        opts['xRange'] = (1, xmax*1.5)
     if opts['yRangeAuto']:
-        opts['yRange'] = (1, np.max(subplot.Data[:,dims[1]])*1.5)
+        opts['yRange'] = (1, ymax*1.5)
     
     # create the subplot and set its attributes
     subplot.axes = figure.add_subplot(subplot.mnp, xlim=opts['xRange'], 
@@ -52,14 +56,13 @@ def scatterplot2D(subplot, figure, dims):
     
     # draw the supplied FACS data
     if (not subplot.isDataClustered()):
-        subplot.axes.plot(subplot.Data[:,dims[0]], 
-                          subplot.Data[:,dims[1]], 
+        subplot.axes.plot(cols[:,0], cols[:,1], 
                           '.', ms=1, color='black')
     else:
-        data = separate(subplot.Data, subplot.Clustering)
+        data = separate(cols, subplot.Clustering)
         for i in range(len(data)):
-            xs = data[i][:,dims[0]]
-            ys = data[i][:,dims[1]]
+            xs = data[i][:,0]
+            ys = data[i][:,1]
             subplot.axes.plot(xs, ys, '.', ms=1, color=methods.plotColors[i])
 
 
@@ -176,13 +176,18 @@ def addPluginFunctionality(parent):
                     submenus[type_].AppendItem(item)
             # Transforms plugins
             elif type_ == pluginTypes[4]:
-                pID = wx.NewId()
-                tmethod, tscaleClass = eval('module.'+method)()
-                doc = tmethod.__doc__.split(';')
-                strID = doc[0].strip()
-                name  = doc[1].strip()
-                descr = doc[2].strip()
-                tm.addPluginMethod((strID, pID, name, descr, tmethod, tscaleClass))
+                for method in pluginMethods:
+                    pID = wx.NewId()
+                    tmethod, tscaleClass = eval('module.'+method)()
+                    doc = tmethod.__doc__.split(';')
+                    strID = doc[0].strip()
+                    name  = doc[1].strip()
+                    descr = doc[2].strip()
+                    tm.addPluginMethod((strID, pID, name, descr, tmethod, tscaleClass))
+                    # Create a disabled menu item to indicate plugin was loaded
+                    item = wx.MenuItem(submenus[type_], pID, name, descr)
+                    item.Enable(False)
+                    submenus[type_].AppendItem(item)
             
  
     # Add submenus to main menu
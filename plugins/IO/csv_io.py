@@ -1,20 +1,37 @@
 """
 This module provides the functionality to 
 read and write CSV files from FC data. 
+
+CSV files (which may be gzip or bzip2 compressed) are parsed a block of 
+lines at a time into a preallocated array, so large files load quickly and
+without holding more than one block of text in memory.
 """
 from data.io import FILE_INPUT, FILE_OUTPUT
+from data.handle import compactData
 from display.dialogs import ValidatedDialog
 from plugins.pluginbase import IOPlugin 
 
-from numpy import loadtxt
+import numpy as np
 import wx
 
-import csv
+import bz2
+import gzip
+import os
+import warnings
+
+__all__ = ['register_csv', 'register_csv_gz', 'register_csv_bz2']
+
+# bytes of text parsed at a time
+CSV_BLOCK_BYTES = 16 * 1024**2
 
-__all__ = ['register_csv']
+# events formatted at a time when writing
+CSV_WRITE_EVENTS = 65536
 
 class CSVPlugin(IOPlugin):
     """Read and write CSV files."""
+    # the import options dialog must be shown on the GUI thread
+    interactive = True
+    
     def __init__(self, filename=None, fcData=None, window=None):
         super(CSVPlugin, self).__init__(filename, fcData, window)
     
@@ -25,7 +42,7 @@ class CSVPlugin(IOPlugin):
     def FileType(self):
         return 'Comma Separated Values (*.csv)|*.csv' 
     
-    def load(self):
+    def load(self, **kwargs):
         """
         Load the specified FACS data file. It is assumed that the first line
         of the file contains the column labels.
@@ -47,21 +64,13 @@ class CSVPlugin(IOPlugin):
             skiprows = dlg.HeaderLineNumber
             commentChar = dlg.CommentCharacter
             dlg.Destroy()            
-        
-            # Retrieve first line of column labels
-            with open(self.filename,'r') as fcFile:
-                for i, line in enumerate(fcFile):
-                    if i < skiprows:
-                        labels = line
-                    else:
-                        break
-                labels = labels.rstrip().replace('"','').replace("'",'').split(delim)
             
             # load actual data
             try:
-                data = loadtxt(self.filename, comments=commentChar, delimiter=delim, skiprows=skiprows)
+                labels, data = readCSV(self.filename, delim, skiprows, commentChar, 
+                                       self.reportProgress)
             except Exception:
-                wx.MessageBox("Please ensure there are no missing values and that correct values for the CSV options were specified.",
+                wx.MessageBox("Please ensure that correct values for the CSV options were specified.",
                               "Data Loading Error", wx.OK | wx.ICON_ERROR)
                 return
             
@@ -74,18 +83,252 @@ class CSVPlugin(IOPlugin):
         else:
             dlg.Destroy() 
 
+    def reportProgress(self, fraction, rows):
+        """Show the progress of a load in the status bar of the main window."""
+        statusbar = getattr(self.window, 'statusbar', None)
+        if statusbar is None:
+            return
+        msg = 'loading %s: %i events' % (os.path.basename(self.filename), rows)
+        if fraction is not None:
+            msg += ' (%i%%)' % (100*fraction)
+        statusbar.SetStatusText(msg, 0)
+        statusbar.Update()
 
     
     def save(self):
         """
         Save the supplied Flow Cytometry data to a comma separated value file.
         """
-        writer = csv.writer(open(self.filename, 'w'), delimiter=',')
-        writer.writerow(self.fcData.labels)
-        writer.writerows(self.fcData.data)
+        dlg = CSVExportDialog(self.window, self.fcData.selectedClustering is not None)
+        if dlg.ShowModal() == wx.ID_OK:
+            filename = self.filename
+            if dlg.Compress and not filename.lower().endswith('.gz'):
+                filename += '.gz'
+            clusterIDs = self.fcData.getCurrentClustering() if dlg.IncludeClustering else None
+            writeCSV(filename, self.fcData.labels, self.fcData, dlg.Delimiter, 
+                     dlg.Precision, clusterIDs)
+        dlg.Destroy()
         
         
         
+class CompressedCSVPlugin(CSVPlugin):
+    """Read gzip or bzip2 compressed CSV files."""
+    def register(self):
+        return {FILE_INPUT: self.load}
+    
+    @property
+    def FileType(self):
+        return 'Compressed CSV (*.csv.gz, *.csv.bz2)|*.csv.gz;*.csv.bz2'
+
+
+
+def readCSV(filename, delimiter=',', skiprows=1, comments='#', progress=None):
+    """
+    Read the column labels and data from a delimited text file, which may be
+    gzip (.gz) or bzip2 (.bz2) compressed.
+    
+    Blocks of lines are parsed directly into a preallocated array, which 
+    grows as needed. Missing or non-numeric values are read as NaN. The 
+    data are returned as the smallest integer type holding them if all
+    values are integers, or otherwise as 32-bit floats.
+    
+    @type filename: str
+    @param filename: The path to the file.
+    @type delimiter: str
+    @param delimiter: The character separating the values on each line.
+    @type skiprows: int
+    @param skiprows: The number of lines before the data, the last of which 
+                     holds the column labels.
+    @type comments: str
+    @param comments: The character starting a comment.
+    @type progress: callable
+    @param progress: Called after each block as progress(fraction, rows) 
+                     with the fraction of the file read (or None if that is 
+                     not known) and the number of events read.
+    @rtype: tuple
+    @return: The list of column labels and the m x n data array.
+    """
+    fh, raw = openCSV(filename)
+    try:
+        labels = ''
+        for i in range(skiprows):
+            labels = fh.readline()
+        labels = labels.rstrip().replace('"','').replace("'",'').split(delimiter)
+        ncols = len(labels)
+        size = os.path.getsize(filename)
+        
+        data = None
+        rows = 0
+        while True:
+            lines = fh.readlines(CSV_BLOCK_BYTES)
+            if not lines:
+                break
+            block = parseCSVBlock(lines, delimiter, comments, ncols)
+            
+            # integer data are kept as such until a block needs floats
+            if (data is None or data.dtype.kind != 'f') and isIntegral(block):
+                dtype = np.dtype(np.int32)
+            else:
+                dtype = np.dtype(np.float32)
+            
+            if data is None:
+                # estimate the number of events from the size of the first block
+                estimate = len(block) + 1
+                if raw is fh:
+                    estimate = int(size / float(sum([len(l) for l in lines])) * len(block) * 1.05) + 1
+                data = np.empty((max(estimate, len(block)), ncols), dtype=dtype)
+            elif dtype != data.dtype:
+                data = data.astype(dtype)
+            if rows + len(block) > len(data):
+                data.resize((max(rows + len(block), int(len(data)*1.5)), ncols), refcheck=False)
+            data[rows:rows+len(block)] = block
+            rows += len(block)
+            
+            if progress is not None:
+                progress(raw.tell() / float(size) if raw is not None and size else None, rows)
+    finally:
+        fh.close()
+        if raw is not None and raw is not fh:
+            raw.close()
+    
+    if data is None:
+        return labels, np.empty((0, ncols), dtype=np.float32)
+    data.resize((rows, ncols), refcheck=False)
+    return labels, compactData(data)
+
+
+def openCSV(filename):
+    """
+    Open a (possibly compressed) text file for reading.
+    
+    @rtype: tuple
+    @return: The file object for the text, and the underlying file whose 
+             position gives the progress through the file (None if it can 
+             not be determined).
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.gz':
+        raw = open(filename, 'rb')
+        return gzip.GzipFile(fileobj=raw, mode='rb'), raw
+    if ext == '.bz2':
+        return bz2.BZ2File(filename, 'rb'), None
+    fh = open(filename, 'rb')
+    return fh, fh
+
+
+def parseCSVBlock(lines, delimiter, comments, ncols):
+    """
+    Parse a list of delimited lines into an m x ncols float64 array. 
+    
+    The whole block is converted at once by numpy when it is well formed, 
+    otherwise each value is converted separately, with missing or invalid 
+    values (and missing columns) read as NaN.
+    """
+    if comments and any([comments in l for l in lines]):
+        lines = [l.split(comments, 1)[0] for l in lines]
+    lines = [l for l in lines if l.strip()]
+    if not lines:
+        return np.empty((0, ncols))
+    
+    text = ''.join([l if l.endswith('\n') else l + '\n' for l in lines])
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            values = np.fromstring(text.replace('\n', delimiter), sep=delimiter)
+        except ValueError:
+            values = None
+    # the total only places values correctly if every line has ncols fields
+    if (values is not None and len(values) == len(lines)*ncols and 
+        all([l.count(delimiter) == ncols-1 for l in lines])):
+        return values.reshape((len(lines), ncols))
+    
+    # slow path for malformed blocks
+    block = np.empty((len(lines), ncols))
+    block.fill(np.nan)
+    for i, line in enumerate(lines):
+        for j, value in enumerate(line.rstrip('\r\n').split(delimiter)[:ncols]):
+            try:
+                block[i, j] = float(value.strip().strip('"\''))
+            except ValueError:
+                pass
+    return block
+
+
+def writeCSV(filename, labels, data, delimiter=',', precision=None, clusterIDs=None):
+    """
+    Write the column labels and data to a delimited text file, gzip 
+    compressed if the filename ends in .gz. This does not require the GUI, 
+    so it can be used for batch exports.
+    
+    Each block of events is formatted with a single string operation and 
+    written through a buffered file.
+    
+    @type filename: str
+    @param filename: The path to the file.
+    @type labels: list
+    @param labels: The column labels, written as the first line.
+    @type data: numpy.ndarray
+    @param data: The m x n data. A FacsData instance may be given, in which 
+                 case lazily loaded data are read a block at a time.
+    @type delimiter: str
+    @param delimiter: The character separating the values on each line.
+    @type precision: int
+    @param precision: The number of significant digits written for floating
+                      point data. By default, enough to represent each 
+                      value exactly.
+    @type clusterIDs: list
+    @param clusterIDs: The cluster of each event, added as a final column 
+                       named "Cluster".
+    """
+    if hasattr(data, 'getRows'):
+        tot, rows = data.EventCount, data.getRows
+    else:
+        tot, rows = len(data), lambda start, stop: data[start:stop]
+    
+    labels = list(labels)
+    if clusterIDs is not None:
+        clusterIDs = np.asarray(clusterIDs)
+        labels.append('Cluster')
+    
+    if tot:
+        dtype = np.asarray(rows(0, 1)).dtype
+    else:
+        dtype = np.dtype(np.float64)
+    if dtype.kind in 'iub':
+        fmt = '%d'
+    else:
+        if precision is None:
+            precision = 9 if dtype.itemsize <= 4 else 17
+        fmt = '%%.%dg' % precision
+    fmts = [fmt] * (len(labels) - (clusterIDs is not None))
+    if clusterIDs is not None:
+        fmts.append('%d')
+    line = delimiter.join(fmts) + '\n'
+    
+    if filename.lower().endswith('.gz'):
+        fh = gzip.open(filename, 'wb', 6)
+    else:
+        fh = open(filename, 'wb', 1024**2)
+    try:
+        fh.write(delimiter.join([l.encode('utf-8') if isinstance(l, unicode) else str(l) 
+                                 for l in labels]) + '\n')
+        for i in xrange(0, tot, CSV_WRITE_EVENTS):
+            block = np.asarray(rows(i, min(i+CSV_WRITE_EVENTS, tot)))
+            if clusterIDs is not None:
+                block = np.column_stack((block, clusterIDs[i:i+len(block)]))
+            fh.write((line * len(block)) % tuple(block.ravel().tolist()))
+    finally:
+        fh.close()
+
+
+def isIntegral(block):
+    """Determine whether all of the values in a block are integers that fit in 32 bits."""
+    return (block.size == 0 or 
+            (np.array_equal(block, np.floor(block)) and
+             block.min() >= -2**31 and block.max() < 2**31))
+
+
+
 import display.formatters as f
 
 class CSVOptionsDialog(ValidatedDialog):
@@ -148,8 +391,77 @@ class CSVOptionsDialog(ValidatedDialog):
         HelpDialog(self, "CSV Import Help", htmlfile="help/csv_import.html", size=(300,200)).Show()
 
 
+class CSVExportDialog(ValidatedDialog):
+    def __init__(self, parent, clustering=False):
+        wx.Dialog.__init__(self, parent, wx.ID_ANY, 'CSV File Export Options', size=(250, 250))
+        self.CenterOnParent()
+        
+        # form controls
+        self.txtDelimiter = wx.TextCtrl(self, wx.ID_ANY, ',', size=(50,20))
+        self.txtPrecision = wx.TextCtrl(self, wx.ID_ANY, '', size=(50,20))
+        self.chkCompress = wx.CheckBox(self, wx.ID_ANY, 'Compress (gzip)')
+        self.chkClustering = wx.CheckBox(self, wx.ID_ANY, 'Add cluster IDs')
+        self.chkClustering.Enable(clustering)
+        
+        # create a table of label-input controls
+        self.formSizer = wx.GridSizer(2, 2, vgap=20)
+        self.formSizer.Add(wx.StaticText(self, wx.ID_ANY, 'Delimiter:'), 1, wx.EXPAND | wx.ALIGN_RIGHT)
+        self.formSizer.Add(self.txtDelimiter, 1)
+        self.formSizer.Add(wx.StaticText(self, wx.ID_ANY, 'Significant digits:'), 1, wx.EXPAND | wx.ALIGN_RIGHT)
+        self.formSizer.Add(self.txtPrecision, 1)
+        
+        # create the button row
+        self.buttonSizer = self.CreateButtonSizer(wx.OK | wx.CANCEL)
+        self.buttonSizer.AffirmativeButton.Bind(wx.EVT_BUTTON, super(CSVExportDialog, self).cmdOK_click)
+        
+        # main sizer
+        self.sizer = wx.BoxSizer(wx.VERTICAL)
+        self.sizer.Add(self.formSizer, 1, wx.EXPAND | wx.LEFT | wx.RIGHT | wx.TOP, 20)
+        self.sizer.Add(self.chkCompress, 0, wx.LEFT | wx.RIGHT | wx.TOP, 20)
+        self.sizer.Add(self.chkClustering, 0, wx.LEFT | wx.RIGHT | wx.TOP, 20)
+        self.sizer.Add(self.buttonSizer, 0, wx.EXPAND | wx.LEFT | wx.RIGHT | wx.TOP | wx.BOTTOM, 20)
+        self.SetSizer(self.sizer)
+    
+    @property
+    def Delimiter(self):
+        return self.txtDelimiter.Value.replace('\\t', '\t')
+    
+    @property
+    def Precision(self):
+        if self.txtPrecision.Value.strip():
+            return int(self.txtPrecision.Value)
+    
+    @property
+    def Compress(self):
+        return self.chkCompress.Value
+    
+    @property
+    def IncludeClustering(self):
+        return self.chkClustering.IsEnabled() and self.chkClustering.Value
+    
+    def validate(self):
+        intVal = f.IntFormatter()
+        msg = []
+        
+        if not self.txtDelimiter.Value:
+            msg.append("Delimiter: A delimiter must be entered.")
+        if self.txtPrecision.Value.strip():
+            if not intVal.validate(self.txtPrecision.Value):
+                msg.append("Significant digits: A valid number must be entered.")
+            elif int(self.txtPrecision.Value) <= 0:
+                msg.append("Significant digits: Please enter a number larger than 0.")
+        
+        return msg
+
+
 def register_csv():
     return ('csv', CSVPlugin)
+
+def register_csv_gz():
+    return ('csv.gz', CompressedCSVPlugin)
+
+def register_csv_bz2():
+    return ('csv.bz2', CompressedCSVPlugin)
         
         
         
@@ -5,6 +5,7 @@ Created on Jul 30, 2009
 '''
 from plugins.pluginbase import ClusterOptionsDialog
 
+import numpy as np
 import wx
 
 __all__ = ['unicluster_register']
@@ -15,9 +16,7 @@ def unicluster(data, **kwargs):
     
     @var data: The input data to be clustered.
     """
-    clustering = []
-    for i in range(len(data)):
-        clustering.append(0)
+    clustering = np.zeros(len(data), dtype=np.uint8)
         
     return clustering,'One cluster found'
         
@@ -27,19 +27,24 @@ def heatmap2d(subplot, figure, dims):
     subplot.axes.set_xlabel(subplot.Labels[dims[0]])
     subplot.axes.set_ylabel(subplot.Labels[dims[1]])
     
-    x = subplot.Data[:, dims[0]]
-    y = subplot.Data[:, dims[1]]
+    cols = subplot.getColumns(list(dims))
+    x = cols[:,0]
+    y = cols[:,1]
+    xmax, ymax = subplot.getStats(list(dims))['max']
     cbLabel = ''
     
-    # apply transform
+    # apply transform, along with the (monotonic) transform of the maxima
     if 'transform' not in opts:
         opts['transform'] = 'log'
-    if opts['transform'] == 'log':
-        x = tm.getMethod('log')(x)
-        y = tm.getMethod('log')(y)
+    if opts['transform'] in tm.AvailableMethods():
+        xform = tm.getMethod(opts['transform'])
+        x = xform(x, max_clip=xmax)
+        y = xform(y, max_clip=ymax)
+        xmax = xform(np.array([xmax]), max_clip=xmax)[0]
+        ymax = xform(np.array([ymax]), max_clip=ymax)[0]
     
     
-    extent = (0, x.max()*1.05, 0, y.max()*1.05)
+    extent = (0, xmax*1.05, 0, ymax*1.05)
     
     cmap = CM.get_cmap(opts['colorMap'])
     if opts['type'] == 'Hexbins':
@@ -32,10 +32,10 @@ def histogram(subplot, figure, dims):
     subplot.axes = figure.add_subplot(subplot.mnp, title=subplot.Title)
     subplot.axes.set_xlabel(subplot.Labels[dims[0]])
     
-    data = subplot.Data[:, dims[0]]
+    data = subplot.getColumns([dims[0]])[:,0]
     
-    if opts['xTransform'] == 'log':
-        data = tm.getMethod('log')(data)
+    if opts['xTransform'] in tm.AvailableMethods():
+        data = tm.getMethod(opts['xTransform'])(data, max_clip=subplot.getStats([dims[0]])['max'][0])
 
     # Kernel density estimation
     if opts['type'] == 'Gaussian KDE' or opts['type'] == 'Both':
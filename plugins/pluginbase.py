@@ -19,6 +19,13 @@ and any additional documentation the programmer wishes to provide will be
 placed after the final ; delimiter. If these are not provided, the method name 
 and a blank string will be used as the short name and descriptor respectively.
 
+Clustering methods are called as method(data, **kwargs), with the selected 
+columns of the data set and the options from the method's dialog. The keyword 
+arguments also include prepare, a function of a transform ID (and transform 
+options) returning the transformed data. The arrays returned by prepare are 
+cached and shared between runs, and so are read-only; a method that modifies 
+the transformed data in place must copy it first.
+
 @author: Shareef Dabdoub
 @organization: The Ohio State University
 @organization: Nationwide Children's Hospital
@@ -86,7 +93,14 @@ class IOPlugin(Plugin):
     """
     All IOPlugins are expected to provide methods for opening and/or saving 
     data files.
+    
+    Files are read on worker threads when several are opened at once. 
+    Plugins that need to interact with the user while reading (e.g. to show 
+    an options dialog) must set interactive to True so that they are only
+    run on the GUI thread.
     """
+    interactive = False
+    
     def __init__(self, filename=None, fcData=None, window=None):
         self.filename = filename
         self.fcData = fcData
@@ -110,11 +124,16 @@ class IOPlugin(Plugin):
         """
         pass
     
-    def read(self):
+    def read(self, **kwargs):
         """
         Given the specified path of a data file, input the data and return
         it along with the column labels, and any annotations or analysis.
         
+        Loading options (see data.io.loadDataFile) are passed as keyword 
+        arguments; options that are not supported should be ignored. When 
+        preview=N is given, only the first N events need to be returned, 
+        and a plugin should avoid reading the rest of the file if it can.
+        
         :@rtype: tuple
         :@return: (labels, data, annotations, analysis) 
         """
@@ -1,3 +1,3 @@
 """
-This package is meant to house all plugins related to statistical analysis
+This package is meant to house all plugins for data transformations.
 """
\ No newline at end of file
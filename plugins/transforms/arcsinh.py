@@ -0,0 +1,20 @@
+'''
+This module provides the arcsinh data transform and axis scale.
+'''
+from transforms.biexponential import arcsinh as asinh, ArcsinhScale
+
+__all__ = ['arcsinh_register']
+
+def arcsinh(data, **kwargs):
+    """
+    arcsinh; Arcsinh Transform; Transforms data with the inverse hyperbolic sine;
+    
+    kwargs
+    ------
+    cofactor: The width of the linear region around zero (default 150).
+    """
+    return asinh(data, float(kwargs.get('cofactor', 150)))
+
+
+def arcsinh_register():
+    return (arcsinh, ArcsinhScale)
@@ -3,3 +3,23 @@ Created on Jul 30, 2009
 
 @author: shareef
 '''
+from transforms.biexponential import Hyperlog, HyperlogScale, transformArgs
+
+__all__ = ['hyperlog_register']
+
+def hyperlog(data, **kwargs):
+    """
+    hyperlog; Hyperlog Transform; Transforms data to the hyperlog scale;
+    
+    kwargs
+    ------
+    T: The top of the data scale (default 262144).
+    W: Decades of linear behavior around zero (default 0.5).
+    M: Decades spanned by the full scale (default 4.5).
+    A: Additional decades of negative data (default 0).
+    """
+    return Hyperlog(**transformArgs(kwargs))(data)
+
+
+def hyperlog_register():
+    return (hyperlog, HyperlogScale)
@@ -0,0 +1,23 @@
+'''
+This module provides the logicle (biexponential) data transform and axis scale.
+'''
+from transforms.biexponential import Logicle, LogicleScale, transformArgs
+
+__all__ = ['logicle_register']
+
+def logicle(data, **kwargs):
+    """
+    logicle; Logicle Transform; Transforms data to the logicle (biexponential) scale;
+    
+    kwargs
+    ------
+    T: The top of the data scale (default 262144).
+    W: Decades of linear-like behavior around zero (default 0.5).
+    M: Decades spanned by the full scale (default 4.5).
+    A: Additional decades of negative data (default 0).
+    """
+    return Logicle(**transformArgs(kwargs))(data)
+
+
+def logicle_register():
+    return (logicle, LogicleScale)
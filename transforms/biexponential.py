@@ -0,0 +1,303 @@
+'''
+This module provides the display transforms used for compensated flow
+cytometry data, which (unlike a log scale) show zero and negative values:
+logicle, hyperlog and arcsinh, along with matplotlib scales for each.
+
+Logicle and hyperlog have no closed form; they are defined as the inverse
+of a function from scale to data values. Rather than root finding for each
+value, that function is tabulated once per set of parameters and the
+data are transformed by interpolating in the table.
+
+The logicle and hyperlog parameterizations follow:
+D.R. Parks, M. Roederer, and W.A. Moore, "A new 'Logicle' display method
+avoids deceptive effects of logarithmic scaling for low signals and
+compensated data", Cytometry A, vol. 69, 2006, pp. 541-551.
+
+W.A. Moore and D.R. Parks, "Update for the logicle data scale including
+operational code implementations", Cytometry A, vol. 81, 2012, pp. 273-277.
+
+@author: Shareef Dabdoub
+@organization: The Ohio State University
+@organization: Nationwide Children's Hospital
+'''
+from matplotlib import scale as mscale
+import matplotlib.ticker as mticker
+import matplotlib.transforms as mtransforms
+import numpy as np
+from scipy.optimize import brentq
+
+import math
+
+# number of points tabulated for each transform
+TABLE_SIZE = 16384
+# the range of scale values tabulated; 0 to 1 is the normal display range
+TABLE_RANGE = (-0.25, 1.25)
+
+# tabulated transforms, keyed on class and parameters
+_tables = {}
+
+
+class BiexTransform(object):
+    """
+    Base class for the logicle and hyperlog transforms. Both are defined by
+    the parameters:
+
+        - T: the top of the data scale
+        - W: the number of decades of linear-like behavior around zero
+        - M: the number of decades spanned by the full (0 to 1) scale
+        - A: the number of additional decades of negative data
+
+    and by an inverse function, symmetric about the scale value of data
+    zero, which subclasses provide through the _inverse method.
+    """
+    def __init__(self, T=262144, W=0.5, M=4.5, A=0):
+        self.T = float(T)
+        self.W = float(W)
+        self.M = float(M)
+        self.A = float(A)
+
+        self.w = self.W / (self.M + self.A)
+        self.x2 = self.A / (self.M + self.A)
+        self.x1 = self.x2 + self.w
+        self.x0 = self.x2 + 2*self.w
+        self.b = (self.M + self.A) * math.log(10)
+
+    def _inverse(self, y):
+        """Map scale values y >= x1 to data values."""
+        pass
+
+    def inverse(self, y):
+        """
+        Map scale values back to data values.
+
+        :@type y: array
+        :@param y: Transformed values.
+        :@rtype: numpy.ndarray
+        """
+        y = np.asarray(y, dtype=np.float64)
+        negative = y < self.x1
+        y = np.where(negative, 2*self.x1 - y, y)
+        x = self._inverse(y)
+        return np.where(negative, -x, x)
+
+    @property
+    def table(self):
+        """
+        The (data values, scale values) table for the transform, computed
+        on first use for each distinct set of parameters.
+        """
+        key = (self.__class__, self.T, self.W, self.M, self.A)
+        if key not in _tables:
+            ys = np.linspace(TABLE_RANGE[0], TABLE_RANGE[1], TABLE_SIZE)
+            _tables[key] = (self.inverse(ys), ys)
+        return _tables[key]
+
+    def __call__(self, data):
+        """
+        Transform the data to the scale. Values outside the tabulated range
+        are clipped to its ends.
+
+        :@type data: array
+        :@param data: The data to be transformed.
+        :@rtype: numpy.ndarray
+        :@return: The transformed data, with data values of 0 to T mapped
+                  to x1 to 1.
+        """
+        xs, ys = self.table
+        data = np.asarray(data)
+        out = np.empty(data.shape, dtype=np.float64)
+        # work by column to bound the temporary float copies of integer data
+        if data.ndim == 2:
+            for i in range(data.shape[1]):
+                out[:,i] = np.interp(data[:,i], xs, ys)
+        else:
+            out[...] = np.interp(data, xs, ys)
+        return out
+
+
+class Logicle(BiexTransform):
+    """
+    The logicle (biexponential) transform.
+    """
+    def __init__(self, T=262144, W=0.5, M=4.5, A=0):
+        super(Logicle, self).__init__(T, W, M, A)
+        b, w = self.b, self.w
+
+        # d satisfies w = 2ln(d/b) / (b+d)
+        if w == 0:
+            self.d = b
+        else:
+            self.d = brentq(lambda d: 2*(math.log(d) - math.log(b)) + w*(b + d),
+                            1e-12, b)
+        d = self.d
+
+        ca = math.exp(self.x0 * (b + d))
+        mfa = math.exp(b * self.x1) - ca / math.exp(d * self.x1)
+        self.a = self.T / ((math.exp(b) - mfa) - ca / math.exp(d))
+        self.c = ca * self.a
+        self.f = -mfa * self.a
+
+    def _inverse(self, y):
+        return self.a*np.exp(self.b*y) - self.c*np.exp(-self.d*y) + self.f
+
+
+class Hyperlog(BiexTransform):
+    """
+    The hyperlog transform, which is linear rather than exponential near
+    zero.
+    """
+    def __init__(self, T=262144, W=0.5, M=4.5, A=0):
+        super(Hyperlog, self).__init__(T, W, M, A)
+        b = self.b
+
+        ca = math.exp(b * self.x0) / self.w
+        fa = math.exp(b * self.x1) + ca * self.x1
+        self.a = self.T / ((math.exp(b) + ca) - fa)
+        self.c = ca * self.a
+        self.f = fa * self.a
+
+    def _inverse(self, y):
+        return self.a*np.exp(self.b*y) + self.c*y - self.f
+
+
+def arcsinh(data, cofactor=150):
+    """
+    Apply the inverse hyperbolic sine transform, arcsinh(x/cofactor).
+
+    :@type data: array
+    :@param data: The data to be transformed.
+    :@type cofactor: float
+    :@param cofactor: The width of the linear region around zero.
+    :@rtype: numpy.ndarray
+    """
+    data = np.asarray(data)
+    if data.dtype.kind != 'f':
+        data = data.astype(np.float64)
+    return np.arcsinh(data / float(cofactor))
+
+
+def transformArgs(kwargs):
+    """
+    Retrieve the T, W, M and A logicle/hyperlog parameters present in a dict
+    of transform or plot options.
+
+    :@rtype: dict
+    """
+    return dict([(p, float(kwargs[p])) for p in 'TWMA' if p in kwargs])
+
+
+
+#--------------------
+# MATPLOTLIB SCALES
+#--------------------
+class BiexLocator(mticker.Locator):
+    """
+    Place ticks at zero and at the powers of ten (positive and negative)
+    within the view range. Tick locations are in data units.
+    """
+    def __call__(self):
+        vmin, vmax = self.axis.get_view_interval()
+        return self.tick_values(vmin, vmax)
+
+    def tick_values(self, vmin, vmax):
+        if vmax < vmin:
+            vmin, vmax = vmax, vmin
+        ticks = [0] if vmin <= 0 <= vmax else []
+        for sign in (1, -1):
+            for e in range(0, 10):
+                t = sign * 10**e
+                if vmin <= t <= vmax:
+                    ticks.append(t)
+        return self.raise_if_exceeds(np.array(sorted(ticks), dtype=np.float64))
+
+
+class BiexFormatter(mticker.Formatter):
+    """Label powers of ten as 10^n, and zero."""
+    def __call__(self, x, pos=None):
+        if x == 0:
+            return '0'
+        e = int(round(math.log10(abs(x))))
+        return '%s$10^{%d}$' % ('-' if x < 0 else '', e)
+
+
+class BiexScale(mscale.ScaleBase):
+    """
+    A matplotlib scale applying a data transform to an axis. Subclasses
+    set name and create the transform function in _function; plotting
+    options are ignored.
+    """
+    name = None
+
+    def __init__(self, axis, **kwargs):
+        self.func = self._function(transformArgs(kwargs))
+
+    def _function(self, args):
+        pass
+
+    def get_transform(self):
+        return FunctionTransform(self.func)
+
+    def set_default_locators_and_formatters(self, axis):
+        axis.set_major_locator(BiexLocator())
+        axis.set_major_formatter(BiexFormatter())
+        axis.set_minor_formatter(mticker.NullFormatter())
+
+    def limit_range_for_scale(self, vmin, vmax, minpos):
+        return vmin, vmax
+
+
+class FunctionTransform(mtransforms.Transform):
+    """
+    A separable matplotlib transform wrapping a transform function and its
+    inverse (available as func.inverse).
+    """
+    input_dims = 1
+    output_dims = 1
+    is_separable = True
+
+    def __init__(self, func, inverted=False):
+        mtransforms.Transform.__init__(self)
+        self.func = func
+        self.isInverted = inverted
+
+    def transform_non_affine(self, a):
+        if self.isInverted:
+            return self.func.inverse(a)
+        return self.func(a)
+    transform = transform_non_affine
+
+    def inverted(self):
+        return FunctionTransform(self.func, not self.isInverted)
+
+
+class LogicleScale(BiexScale):
+    name = 'logicle'
+
+    def _function(self, args):
+        return Logicle(**args)
+
+
+class HyperlogScale(BiexScale):
+    name = 'hyperlog'
+
+    def _function(self, args):
+        return Hyperlog(**args)
+
+
+class Arcsinh(object):
+    """The arcsinh transform with a fixed cofactor, for use by ArcsinhScale."""
+    def __init__(self, cofactor=150):
+        self.cofactor = float(cofactor)
+
+    def __call__(self, data):
+        return arcsinh(data, self.cofactor)
+
+    def inverse(self, y):
+        return np.sinh(np.asarray(y, dtype=np.float64)) * self.cofactor
+
+
+class ArcsinhScale(BiexScale):
+    name = 'arcsinh'
+
+    def __init__(self, axis, **kwargs):
+        self.func = Arcsinh(kwargs.get('cofactor', 150))
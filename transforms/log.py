@@ -25,10 +25,16 @@ def log(data, **kwargs):
     :@type min_clip: float
     :@param min_clip: The minimum value boundary. Values outside the boundary 
                       will be clipped to this value.
+    :@type max_clip: float
+    :@param max_clip: The maximum value boundary. Defaults to the maximum of 
+                      the data; callers that know it (e.g. from 
+                      L{data.store.FacsData.Stats}) can pass it to avoid a 
+                      pass over the data.
     
     """
     base = 10
     min_clip = 0.00001
+    max_clip = None
     
     if 'base' in kwargs:
         try:
@@ -37,6 +43,13 @@ def log(data, **kwargs):
             base = kwargs['base']
     if 'min_clip' in kwargs:
         min_clip = float(kwargs['min_clip'])
+    if kwargs.get('max_clip') is not None:
+        max_clip = float(kwargs['max_clip'])
+    
+    # integer data must be promoted so the clip bound is not truncated to 0
+    data = np.asarray(data)
+    if data.dtype.kind != 'f':
+        data = data.astype(np.float64)
     
     func = np.log10
     
@@ -45,7 +58,10 @@ def log(data, **kwargs):
     elif base == 'e':
         func = np.log1p
     
-    return func(np.clip(data, a_min=min_clip, a_max=np.max(np.maximum.reduce(data))))
+    if max_clip is None:
+        max_clip = np.max(np.maximum.reduce(data))
+    
+    return func(np.clip(data, a_min=min_clip, a_max=max_clip))
 
 
 class LogLocator(mticker.Locator):
@@ -45,6 +45,18 @@ def AvailableMethods():
     """
     return methods
 
+def getScaleTransforms():
+    """
+    Retrieve the IDs of the transforms that can be applied to plot axes, 
+    i.e. those with a matplotlib scale of the same name.
+    
+    @rtype: list
+    @return: 'linear' followed by the sorted IDs of the axis transforms.
+    """
+    return ['linear'] + sorted([id for id in methods 
+                                if id == 'log' or methods[id][-2] is not None])
+
+
 def getMethod(id):
     """
     Retrieve a plotting method by its ID.